@@ -3,22 +3,33 @@ import torch
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
-from .image_encoder import ImageEncoder
+from .image_encoder import ImageEncoder, TracedImageEncoder
 from .location_encoder import LocationEncoder
-from .misc import load_gps_data, file_dir
-
-from PIL import Image
-from torchvision.transforms import ToPILImage
+from .misc import load_gps_data, load_image, local_grid, file_dir
+from .gallery_cache import load_gallery_features, state_dict_sha256
+from .ann_index import load_ann_index
+from .quantized_gallery import load_quantized_gallery
+from .scoring import chunked_topk, DEFAULT_CHUNK_SIZE
+from .preprocess import FastPreprocessor
 
 class GeoCLIP(nn.Module):
-    def __init__(self, from_pretrained=True, queue_size=4096):
+    def __init__(self, from_pretrained=True, queue_size=4096, image_encoder=None):
         super().__init__()
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
-        self.image_encoder = ImageEncoder()
+        self.image_encoder = image_encoder if image_encoder is not None else ImageEncoder()
         self.location_encoder = LocationEncoder(from_pretrained=from_pretrained)
 
-        self.gps_gallery = load_gps_data(os.path.join(file_dir, "gps_gallery", "coordinates_100K.csv"))
+        self.gps_gallery_path = os.path.join(file_dir, "gps_gallery", "coordinates_100K.csv")
+        self.gps_gallery = load_gps_data(self.gps_gallery_path)
+        self.register_buffer("gallery_features", None, persistent=False)
+        self.gallery_cache_dir = None
+        self.gallery_index = None
+        self.region_galleries = {}
+        self.refinement = None
+        self.scoring_chunk_size = DEFAULT_CHUNK_SIZE
+        self.fast_preprocessor = None
         self._initialize_gps_queue(queue_size)
+        self.iteration_id = None
 
         if from_pretrained:
             self.weights_folder = os.path.join(file_dir, "weights")
@@ -45,14 +56,22 @@ class GeoCLIP(nn.Module):
 
     def load_finetuned_weights(self, weight_dir: str=None, iteration_id: str='0') -> None:
         weights_path = weight_dir if weight_dir is not None else self.weights_folder
+        self.iteration_id = iteration_id
+        self.gallery_features = None
+        self.gallery_index = None
+        self.region_galleries = {}
 
-        self.image_encoder.mlp.load_state_dict(
-            torch.load(
-                os.path.join(weights_path, f"image_encoder_mlp_weights_{iteration_id}.pth"),
-                map_location=torch.device(self.device),
-                weights_only=True
-            )
+        mlp_state_dict = torch.load(
+            os.path.join(weights_path, f"image_encoder_mlp_weights_{iteration_id}.pth"),
+            map_location=torch.device(self.device),
+            weights_only=True
         )
+        if isinstance(self.image_encoder, TracedImageEncoder):
+            # the MLP head is frozen into the traced graph
+            if state_dict_sha256(mlp_state_dict) != self.image_encoder.mlp_sha256:
+                raise ValueError(f"{self.image_encoder.path} was exported from other MLP weights than iteration {iteration_id}")
+        else:
+            self.image_encoder.mlp.load_state_dict(mlp_state_dict)
         self.location_encoder.load_state_dict(
             torch.load(
                 os.path.join(weights_path, f"location_encoder_weights_{iteration_id}.pth"),
@@ -73,8 +92,121 @@ class GeoCLIP(nn.Module):
         self.image_encoder.to(device)
         self.location_encoder.to(device)
         self.logit_scale.data = self.logit_scale.data.to(device)
+        self.region_galleries = {
+            name: (gps, features.to(device)) for name, (gps, features) in self.region_galleries.items()
+        }
         return super().to(device)
 
+    def set_gallery(self, csv_file: str) -> None:
+        """ Replace the GPS gallery, e.g. with a region restricted one from misc.restrict_gallery.
+        load_gallery_features must be called again afterwards to use cached features.
+
+        Args:
+            csv_file (str): Gallery csv with LAT and LON columns
+        """
+        self.gps_gallery_path = csv_file
+        self.gps_gallery = load_gps_data(csv_file)
+        self.gallery_features = None
+        self.gallery_index = None
+
+    def add_region_gallery(self, name: str, csv_file: str, cache_dir: str) -> None:
+        """ Load an additional gallery, with its cached features, that predict can be restricted to
+
+        Args:
+            name (str): Name passed as the region argument of predict
+            csv_file (str): Gallery csv with LAT and LON columns
+            cache_dir (str): Directory holding the gallery feature cache
+        """
+        gps_gallery = load_gps_data(csv_file)
+        gallery_features = load_gallery_features(
+            self.location_encoder,
+            gps_gallery,
+            cache_dir=cache_dir,
+            cache_name=self._gallery_cache_name(csv_file),
+            device=self.device
+        ).to(self.device)
+        self.region_galleries[name] = (gps_gallery, gallery_features)
+
+    def load_gallery_features(self, cache_dir: str) -> None:
+        """ Load the precomputed, normalized GPS gallery features used by predict
+
+        The features are cached in cache_dir per (weights iteration, gallery file) pair and
+        are recomputed or extended only when the weights or the gallery change.
+
+        Args:
+            cache_dir (str): Directory holding the gallery feature cache
+        """
+        self.gallery_cache_dir = cache_dir
+        self.gallery_features = load_gallery_features(
+            self.location_encoder,
+            self.gps_gallery,
+            cache_dir=cache_dir,
+            cache_name=self._gallery_cache_name(),
+            device=self.device
+        ).to(self.device)
+        self.gallery_index = None
+
+    def load_ann_index(self, nlist: int = 1024, nprobe: int = 32) -> None:
+        """ Build (or load from the gallery cache) an IVF index over the gallery features,
+        after which predict scans only the nprobe closest of the nlist clusters per image.
+        Probabilities are then normalized over the scanned gallery points only.
+
+        Args:
+            nlist (int): Number of clusters of the index
+            nprobe (int): Number of clusters scanned per image, higher is slower but more accurate
+        """
+        if self.gallery_features is None:
+            raise RuntimeError("load_gallery_features must be called before load_ann_index")
+
+        self.gallery_index = load_ann_index(
+            self.gallery_features,
+            cache_dir=self.gallery_cache_dir,
+            cache_name=self._gallery_cache_name(),
+            nlist=nlist,
+            nprobe=nprobe
+        )
+
+    def load_quantized_gallery(self, dtype: str = 'int8', rerank: int = 64) -> None:
+        """ Score the gallery with a float16 or per-row scaled int8 copy of its features (cached next to them),
+        re-ranking the rerank best candidates of each image with the exact float32 features
+
+        Args:
+            dtype (str): 'float16' or 'int8'
+            rerank (int): Number of candidates re-scored in float32
+        """
+        if self.gallery_features is None:
+            raise RuntimeError("load_gallery_features must be called before load_quantized_gallery")
+
+        self.gallery_index = load_quantized_gallery(
+            self.gallery_features,
+            cache_dir=self.gallery_cache_dir,
+            cache_name=self._gallery_cache_name(),
+            dtype=dtype,
+            rerank=rerank,
+            chunk_size=self.scoring_chunk_size
+        )
+
+    def quantize_image_encoder(self, weight_dir: str) -> None:
+        """ Apply dynamic int8 quantization to the Linear layers of the image encoder for CPU inference.
+        The quantized layers are saved in weight_dir and loaded from there on later calls.
+
+        Args:
+            weight_dir (str): Directory of the finetuned weights
+        """
+        if torch.device(self.device).type != 'cpu':
+            raise RuntimeError("The quantized image encoder only runs on CPU")
+        if not isinstance(self.image_encoder, ImageEncoder):
+            raise RuntimeError("Only the eager image encoder can be quantized")
+
+        iteration_id = self.iteration_id if self.iteration_id is not None else 'pretrained'
+        self.image_encoder.load_or_quantize(os.path.join(weight_dir, f"image_encoder_int8_{iteration_id}.pt"))
+
+    def _gallery_cache_name(self, csv_file: str = None) -> str:
+        csv_file = csv_file if csv_file is not None else self.gps_gallery_path
+        gallery_name = os.path.splitext(os.path.basename(csv_file))[0]
+        iteration_id = self.iteration_id if self.iteration_id is not None else 'pretrained'
+        return f"{gallery_name}_{iteration_id}"
+
     def _load_weights(self):
         self.image_encoder.mlp.load_state_dict(torch.load(f"{self.weights_folder}/image_encoder_mlp_weights.pth"))
         self.location_encoder.load_state_dict(torch.load(f"{self.weights_folder}/location_encoder_weights.pth"))
@@ -131,30 +263,228 @@ class GeoCLIP(nn.Module):
 
         return logits_per_image
 
+    def set_fast_preprocessing(self, enabled=True, draft_factor=2.0) -> None:
+        """ Make preprocess_images use preprocess.FastPreprocessor, which matches the image processor
+        of the image encoder within a small tolerance, instead of the image processor itself
+
+        Args:
+            enabled (bool): False restores the image processor
+            draft_factor (float): JPEGs are decoded at no less than draft_factor times the target size
+        """
+        self.fast_preprocessor = None
+        if enabled:
+            self.fast_preprocessor = FastPreprocessor.from_image_processor(
+                self.image_encoder.image_processor, draft_factor=draft_factor
+            )
+
+    def preprocess_images(self, images):
+        """ Decode and preprocess a list of images into a single batch
+
+        Args:
+            images (list): Images accepted by predict (paths, bytes, PIL images, numpy arrays or preprocessed tensors)
+
+        Returns:
+            pixel_values (torch.Tensor): Image tensor of shape (n, 3, 224, 224)
+        """
+        images = list(images)
+        decoded = [i for i, image in enumerate(images) if not isinstance(image, torch.Tensor)]
+        if len(decoded) > 0:
+            if self.fast_preprocessor is not None:
+                pixel_values = self.fast_preprocessor([images[i] for i in decoded])
+            else:
+                pixel_values = self.image_encoder.preprocess_image([load_image(images[i]) for i in decoded])
+            for j, i in enumerate(decoded):
+                images[i] = pixel_values[j]
+
+        return torch.cat([image.reshape(-1, *image.shape[-3:]) for image in images])
+
     @torch.no_grad()
-    def predict(self, image_path, top_k):
-        """ Given an image, predict the top k GPS coordinates
+    def encode_images(self, images):
+        """ Compute the normalized image features of a batch of images
 
         Args:
-            image_path (str): Path to the image
+            images (list | torch.Tensor): Images accepted by preprocess_images or a tensor of shape (n, 3, 224, 224)
+
+        Returns:
+            image_features (torch.Tensor): Normalized image features of shape (n, 512)
+        """
+        if not isinstance(images, torch.Tensor):
+            images = self.preprocess_images(images)
+        image_features = self.image_encoder(images.to(self.device))
+        return F.normalize(image_features, dim=1)
+
+    @torch.no_grad()
+    def search_gallery(self, image_features, top_k, region=None):
+        """ Predict the top k GPS coordinates of the gallery from normalized image features
+
+        Args:
+            image_features (torch.Tensor): Normalized image features of shape (n, 512)
             top_k (int): Number of top predictions to return
+            region (str): Name of a gallery added with add_region_gallery, None for the main gallery
 
         Returns:
-            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (k, 2)
-            top_pred_prob (torch.Tensor): Top k GPS probabilities of shape (k,)
+            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (n, k, 2)
+            top_pred_prob (torch.Tensor): Top k GPS probabilities of shape (n, k)
+        """
+        transform = None
+        if region is not None:
+            if region not in self.region_galleries:
+                raise KeyError(f"Unknown region gallery: {region}")
+            gps_gallery, location_features = self.region_galleries[region]
+        elif self.gallery_index is not None:
+            # ANN index or quantized store, see load_ann_index and load_quantized_gallery
+            top_logits, top_indices, log_norm = self.gallery_index.search(
+                image_features, top_k, scale=self.logit_scale.exp().item()
+            )
+            return self.gps_gallery[top_indices], (top_logits - log_norm.unsqueeze(1)).exp()
+        elif self.gallery_features is not None:
+            gps_gallery, location_features = self.gps_gallery, self.gallery_features
+        else:
+            # no cached features, the gallery is encoded chunk by chunk while it is scored
+            gps_gallery, location_features = self.gps_gallery, self.gps_gallery
+            transform = lambda gps: F.normalize(self.location_encoder(gps), dim=1)
+
+        # the gallery is scored in chunks of scoring_chunk_size with a running top k and log-sum-exp,
+        # which gives the exact softmax probabilities of the top k without the full probability matrix
+        top_logits, top_indices, log_norm = chunked_topk(
+            image_features.to(self.device),
+            location_features,
+            top_k,
+            scale=self.logit_scale.exp().item(),
+            chunk_size=self.scoring_chunk_size,
+            transform=transform
+        )
+        top_pred_gps = gps_gallery[top_indices.cpu()]
+        top_pred_prob = (top_logits - log_norm.unsqueeze(1)).exp().cpu()
+
+        return top_pred_gps, top_pred_prob
+
+    def set_refinement(self, refine_rounds=2, num_candidates=8, grid_size=5, grid_spacing_km=10.0) -> None:
+        """ Make predict refine the gallery predictions, see predict_refined. refine_rounds=0 disables it """
+        self.refinement = None
+        if refine_rounds > 0:
+            self.refinement = {
+                'refine_rounds': refine_rounds,
+                'num_candidates': num_candidates,
+                'grid_size': grid_size,
+                'grid_spacing_km': grid_spacing_km
+            }
+
+    def _score_locations(self, image_features, gps):
+        """ Logits of each image against its own set of locations, gps of shape (n, p, 2) -> (n, p) """
+        location_features = self.location_encoder(gps.reshape(-1, 2))
+        location_features = F.normalize(location_features, dim=1).reshape(*gps.shape[:2], -1)
+        return self.logit_scale.exp() * torch.einsum('nd,npd->np', image_features, location_features)
+
+    @staticmethod
+    def _unique_topk(gps, logits, k):
+        """ Indices of the k best logits of each row, skipping duplicated coordinates """
+        indices = []
+        for row_gps, row_logits in zip(gps, logits):
+            order = row_logits.argsort(descending=True)
+            _, inverse = torch.unique(torch.round(row_gps[order] * 1e5), dim=0, return_inverse=True)
+            first = torch.full((int(inverse.max()) + 1,), len(order), dtype=torch.long, device=order.device)
+            first = first.scatter_reduce(0, inverse, torch.arange(len(order), device=order.device), reduce='amin')
+            indices.append(order[first.sort().values[:k]])
+        return torch.stack(indices)
+
+    @torch.no_grad()
+    def predict_refined(self, image_features, top_k, refine_rounds=2, num_candidates=8, grid_size=5, grid_spacing_km=10.0,
+                        region=None):
+        """ Coarse-to-fine prediction from normalized image features
+
+        The gallery is searched first, then each round places a grid_size x grid_size grid of coordinates
+        around each of the num_candidates best locations found so far, encodes them with the location
+        encoder and scores them. The grid spacing is divided by (grid_size - 1) after every round,
+        so each grid covers one cell of the previous one.
+
+        Args:
+            image_features (torch.Tensor): Normalized image features of shape (n, 512)
+            top_k (int): Number of top predictions to return
+            refine_rounds (int): Number of refinement rounds
+            num_candidates (int): Number of locations refined per round
+            grid_size (int): Number of grid points per side, at least 2
+            grid_spacing_km (float): Spacing of the first round grids in km
+            region (str): Name of a gallery added with add_region_gallery, None for the main gallery
+
+        Returns:
+            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (n, k, 2)
+            top_pred_prob (torch.Tensor): Top k probabilities of shape (n, k), normalized over all scored locations
+        """
+        if grid_size < 2:
+            raise ValueError(f"grid_size must be at least 2, got {grid_size}")
+
+        image_features = image_features.to(self.device)
+        num_candidates = max(num_candidates, top_k)
+        candidates, _ = self.search_gallery(image_features, num_candidates, region=region)
+        pool_gps = candidates.to(self.device)
+        pool_logits = self._score_locations(image_features, pool_gps)
+
+        spacing_km = grid_spacing_km
+        for _ in range(refine_rounds):
+            grid = local_grid(candidates.to(self.device), grid_size, spacing_km)
+            pool_gps = torch.cat([pool_gps, grid], dim=1)
+            pool_logits = torch.cat([pool_logits, self._score_locations(image_features, grid)], dim=1)
+
+            best = self._unique_topk(pool_gps, pool_logits, num_candidates)
+            candidates = torch.gather(pool_gps, 1, best.unsqueeze(-1).expand(-1, -1, 2))
+            spacing_km /= grid_size - 1
+
+        probs = pool_logits.softmax(dim=-1)
+        best = self._unique_topk(pool_gps, pool_logits, top_k)
+        top_pred_gps = torch.gather(pool_gps, 1, best.unsqueeze(-1).expand(-1, -1, 2)).cpu()
+        top_pred_prob = torch.gather(probs, 1, best).cpu()
+
+        return top_pred_gps, top_pred_prob
+
+    @torch.no_grad()
+    def predict_from_features(self, image_features, top_k, region=None):
+        """ Predict the top k GPS coordinates from normalized image features,
+        refining the gallery predictions when set_refinement was called
+
+        Args:
+            image_features (torch.Tensor): Normalized image features of shape (n, 512)
+            top_k (int): Number of top predictions to return
+            region (str): Name of a gallery added with add_region_gallery, None for the main gallery
+
+        Returns:
+            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (n, k, 2)
+            top_pred_prob (torch.Tensor): Top k GPS probabilities of shape (n, k)
         """
-        image = Image.open(image_path)
-        image = self.image_encoder.preprocess_image(image)
-        image = image.to(self.device)
+        if self.refinement is not None:
+            return self.predict_refined(image_features, top_k, region=region, **self.refinement)
+        return self.search_gallery(image_features, top_k, region=region)
 
-        gps_gallery = self.gps_gallery.to(self.device)
+    @torch.no_grad()
+    def predict_batch(self, images, top_k, region=None):
+        """ Given a list of images, predict the top k GPS coordinates of each one
+        with a single image encoder forward and a single gallery matmul
 
-        logits_per_image = self.forward(image, gps_gallery)
-        probs_per_image = logits_per_image.softmax(dim=-1).cpu()
+        Args:
+            images (list): Images accepted by predict
+            top_k (int): Number of top predictions to return per image
+            region (str): Name of a gallery added with add_region_gallery, None for the main gallery
 
-        # Get top k predictions
-        top_pred = torch.topk(probs_per_image, top_k, dim=1)
-        top_pred_gps = self.gps_gallery[top_pred.indices[0]]
-        top_pred_prob = top_pred.values[0]
+        Returns:
+            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (n, k, 2)
+            top_pred_prob (torch.Tensor): Top k GPS probabilities of shape (n, k)
+        """
+        image_features = self.encode_images(images)
+        return self.predict_from_features(image_features, top_k, region=region)
+
+    @torch.no_grad()
+    def predict(self, image, top_k, region=None):
+        """ Given an image, predict the top k GPS coordinates
+
+        Args:
+            image (str | bytes | PIL.Image.Image | np.ndarray | torch.Tensor): Path to the image, its encoded bytes,
+                a decoded image or an already preprocessed tensor of shape (3, 224, 224) or (1, 3, 224, 224)
+            top_k (int): Number of top predictions to return
+            region (str): Name of a gallery added with add_region_gallery, None for the main gallery
 
-        return top_pred_gps, top_pred_prob
\ No newline at end of file
+        Returns:
+            top_pred_gps (torch.Tensor): Top k GPS coordinates of shape (k, 2)
+            top_pred_prob (torch.Tensor): Top k GPS probabilities of shape (k,)
+        """
+        top_pred_gps, top_pred_prob = self.predict_batch([image], top_k, region=region)
+        return top_pred_gps[0], top_pred_prob[0]
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .files import tmp_path, file_lock
+
+
+def features_fingerprint(features: torch.Tensor, num_samples: int = 1024) -> str:
+    """ Cheap fingerprint of a feature matrix: its shape and a strided sample of its rows """
+    step = max(1, features.shape[0] // num_samples)
+    digest = hashlib.sha256(str(tuple(features.shape)).encode())
+    digest.update(features[::step].contiguous().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _assign(x: torch.Tensor, centroids: torch.Tensor, chunk_size: int = 65536) -> torch.Tensor:
+    return torch.cat([
+        (x[start:start + chunk_size] @ centroids.t()).argmax(dim=1)
+        for start in range(0, x.shape[0], chunk_size)
+    ])
+
+
+def _spherical_kmeans(x: torch.Tensor, nlist: int, iterations: int, generator: torch.Generator) -> torch.Tensor:
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:nlist]].clone()
+    for _ in range(iterations):
+        assign = _assign(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=nlist)
+        centroids = F.normalize(sums, dim=1)
+
+        # re-seed empty clusters with random points
+        empty = (counts == 0).nonzero().flatten()
+        if len(empty) > 0:
+            centroids[empty] = x[torch.randint(x.shape[0], (len(empty),), generator=generator)]
+    return centroids
+
+
+class IVFIndex:
+    """ Inverted file index over normalized gallery features
+
+    The gallery is clustered with spherical k-means into nlist lists and the features are stored
+    reordered by list, so a query scans the nprobe lists whose centroids are closest to it
+    instead of the whole gallery. nprobe trades recall for latency.
+    """
+
+    def __init__(self, centroids: torch.Tensor, offsets: torch.Tensor, order: torch.Tensor,
+                 features: torch.Tensor, nprobe: int = 32):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.features = features
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, gallery_features: torch.Tensor, nlist: int = 1024, iterations: int = 10,
+              train_size: int = 64, seed: int = 0, nprobe: int = 32) -> 'IVFIndex':
+        """ Cluster the gallery features, using at most train_size points per list to train the centroids """
+        generator = torch.Generator().manual_seed(seed)
+        features = gallery_features.float().cpu()
+        nlist = min(nlist, features.shape[0])
+
+        sample = torch.randperm(features.shape[0], generator=generator)[:nlist * train_size]
+        centroids = _spherical_kmeans(features[sample], nlist, iterations, generator)
+
+        assign = _assign(features, centroids)
+        order = torch.argsort(assign, stable=True)
+        offsets = torch.zeros(nlist + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.bincount(assign, minlength=nlist), dim=0)
+
+        return cls(centroids, offsets, order, features[order].contiguous(), nprobe=nprobe)
+
+    def save(self, path: str, fingerprint: str) -> None:
+        features_tmp_path = tmp_path(path + ".npy")
+        with open(features_tmp_path, 'wb') as f:
+            np.save(f, self.features.numpy())
+        os.replace(features_tmp_path, path + ".npy")
+
+        index_tmp_path = tmp_path(path + ".npz")
+        with open(index_tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids.numpy(),
+                offsets=self.offsets.numpy(),
+                order=self.order.numpy(),
+                fingerprint=np.array(fingerprint)
+            )
+        os.replace(index_tmp_path, path + ".npz")
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str = None, nprobe: int = 32) -> 'IVFIndex | None':
+        """ Load an index saved with save, None if it is missing or was built for other features """
+        if not os.path.exists(path + ".npz") or not os.path.exists(path + ".npy"):
+            return None
+
+        with np.load(path + ".npz") as data:
+            if fingerprint is not None and str(data['fingerprint']) != fingerprint:
+                return None
+            centroids = torch.from_numpy(data['centroids'])
+            offsets = torch.from_numpy(data['offsets'])
+            order = torch.from_numpy(data['order'])
+        features = torch.from_numpy(np.load(path + ".npy", mmap_mode='c'))
+
+        return cls(centroids, offsets, order, features, nprobe=nprobe)
+
+    @torch.no_grad()
+    def search(self, queries: torch.Tensor, top_k: int, scale: float = 1.0, nprobe: int = None):
+        """ Approximate top k search by inner product
+
+        Args:
+            queries (torch.Tensor): Normalized query features of shape (n, d)
+            top_k (int): Number of results per query
+            scale (float): Factor applied to the similarities, e.g. the model logit scale
+            nprobe (int): Number of lists scanned per query, defaults to the index setting
+
+        Returns:
+            top_logits (torch.Tensor): Scaled similarities of the results, shape (n, k)
+            top_indices (torch.Tensor): Gallery rows of the results, shape (n, k)
+            log_norm (torch.Tensor): Log-sum-exp of the scaled similarities of every scanned row, shape (n,)
+        """
+        queries = queries.float().cpu()
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = (queries @ self.centroids.t()).topk(nprobe, dim=1).indices
+
+        top_logits = torch.empty(queries.shape[0], top_k)
+        top_indices = torch.empty(queries.shape[0], top_k, dtype=torch.long)
+        log_norm = torch.empty(queries.shape[0])
+
+        offsets = self.offsets.tolist()
+        for i, query in enumerate(queries):
+            # lists are stored contiguously, so each probed list is a slice of the reordered features
+            starts = [offsets[list_id] for list_id in probes[i].tolist()]
+            ends = [offsets[list_id + 1] for list_id in probes[i].tolist()]
+            if sum(end - start for start, end in zip(starts, ends)) < top_k:
+                # too few candidates in the probed lists, fall back to the whole gallery
+                starts, ends = [0], [self.features.shape[0]]
+
+            logits = scale * torch.cat([self.features[start:end] @ query for start, end in zip(starts, ends)])
+            top = logits.topk(top_k)
+
+            # map positions in the concatenated scores back to positions in the reordered features
+            lengths = torch.tensor([end - start for start, end in zip(starts, ends)])
+            list_ends = torch.cumsum(lengths, dim=0)
+            slot = torch.searchsorted(list_ends, top.indices, right=True)
+            positions = torch.tensor(starts)[slot] + top.indices - (list_ends - lengths)[slot]
+
+            top_logits[i] = top.values
+            top_indices[i] = self.order[positions]
+            log_norm[i] = torch.logsumexp(logits, dim=0)
+
+        return top_logits, top_indices, log_norm
+
+
+def load_ann_index(gallery_features: torch.Tensor, cache_dir: str, cache_name: str,
+                   nlist: int = 1024, nprobe: int = 32) -> IVFIndex:
+    """ Load the IVF index of a gallery from cache_dir, building and saving it first if it is missing or stale """
+    path = os.path.join(cache_dir, f"{cache_name}.ivf{nlist}")
+    fingerprint = features_fingerprint(gallery_features)
+
+    # workers starting together build the index once, the others wait and load it
+    with file_lock(path):
+        index = IVFIndex.load(path, fingerprint=fingerprint, nprobe=nprobe)
+        if index is None:
+            IVFIndex.build(gallery_features, nlist=nlist, nprobe=nprobe).save(path, fingerprint)
+            index = IVFIndex.load(path, nprobe=nprobe)
+
+    return index
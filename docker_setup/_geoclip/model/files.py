@@ -0,0 +1,28 @@
+import os
+from contextlib import contextmanager
+
+
+def tmp_path(path: str) -> str:
+    """ Temporary file to write path through before renaming it into place, unique to the process
+    so workers building the same file at once do not write to (or rename) each other's file
+    """
+    return f"{path}.{os.getpid()}.tmp"
+
+
+@contextmanager
+def file_lock(path: str):
+    """ Exclusive lock between processes on path + '.lock', held for the duration of the block,
+    so a file is built by a single worker while the others wait and then load it (not taken where fcntl is missing)
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
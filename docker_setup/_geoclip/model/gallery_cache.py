@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .files import tmp_path, file_lock
+
+CACHE_VERSION = 1
+
+
+def tensor_sha256(tensor: torch.Tensor) -> str:
+    return hashlib.sha256(tensor.detach().contiguous().cpu().numpy().tobytes()).hexdigest()
+
+
+def state_dict_sha256(state_dict: dict) -> str:
+    digest = hashlib.sha256()
+    for name, value in sorted(state_dict.items()):
+        digest.update(name.encode())
+        digest.update(value.detach().contiguous().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def module_sha256(module: torch.nn.Module) -> str:
+    return state_dict_sha256(module.state_dict())
+
+
+def _read_meta(meta_path: str) -> dict | None:
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _cached_rows(meta: dict | None, features_path: str, gps_gallery: torch.Tensor, weights_hash: str) -> int:
+    """ Number of leading gallery rows whose cached features are still valid (0 if none are) """
+    if meta is None or not os.path.exists(features_path):
+        return 0
+    if meta.get('version') != CACHE_VERSION or meta.get('weights_sha256') != weights_hash:
+        return 0
+
+    rows = meta.get('rows', 0)
+    if rows > gps_gallery.shape[0] or meta.get('gallery_sha256') != tensor_sha256(gps_gallery[:rows]):
+        return 0
+
+    features = np.load(features_path, mmap_mode='r')
+    if features.shape[0] != rows:
+        return 0
+    return rows
+
+
+@torch.no_grad()
+def _encode_rows(location_encoder, gps: torch.Tensor, out: np.ndarray, device, batch_size: int) -> None:
+    for start in range(0, gps.shape[0], batch_size):
+        batch = gps[start:start + batch_size].to(device)
+        features = F.normalize(location_encoder(batch), dim=1)
+        out[start:start + batch.shape[0]] = features.cpu().numpy()
+
+
+def load_gallery_features(location_encoder, gps_gallery: torch.Tensor, cache_dir: str, cache_name: str,
+                          device='cpu', batch_size: int = 8192) -> torch.Tensor:
+    """ Load the normalized location features of a GPS gallery from disk, building the cache first if needed
+
+    The cache is a .npy file with a .json sidecar holding the sha256 of the gallery coordinates and of the
+    location encoder weights. A stale cache is rebuilt, and a cache built for a prefix of the gallery
+    (coordinates appended to the csv) is extended by encoding only the new rows.
+
+    Args:
+        location_encoder (LocationEncoder): Encoder used to compute the features
+        gps_gallery (torch.Tensor): GPS gallery of shape (m, 2)
+        cache_dir (str): Directory holding the cache files
+        cache_name (str): Base name of the cache files
+        device: Device used to encode missing rows
+        batch_size (int): Number of coordinates encoded at once
+
+    Returns:
+        gallery_features (torch.Tensor): Memory-mapped normalized features of shape (m, 512)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    features_path = os.path.join(cache_dir, f"{cache_name}.npy")
+    meta_path = os.path.join(cache_dir, f"{cache_name}.json")
+
+    weights_hash = module_sha256(location_encoder)
+    num_rows = gps_gallery.shape[0]
+    # workers starting together build the cache once, the others wait and load it
+    with file_lock(features_path):
+        cached = _cached_rows(_read_meta(meta_path), features_path, gps_gallery, weights_hash)
+
+        if cached < num_rows:
+            was_training = location_encoder.training
+            location_encoder.eval()
+
+            features_tmp_path = tmp_path(features_path)
+            with torch.no_grad():
+                dim = location_encoder(gps_gallery[:1].to(device)).shape[1]
+            out = np.lib.format.open_memmap(features_tmp_path, mode='w+', dtype=np.float32, shape=(num_rows, dim))
+            if cached > 0:
+                old = np.load(features_path, mmap_mode='r')
+                for start in range(0, cached, batch_size):
+                    out[start:min(start + batch_size, cached)] = old[start:min(start + batch_size, cached)]
+                del old
+            _encode_rows(location_encoder, gps_gallery[cached:], out[cached:], device, batch_size)
+            out.flush()
+            del out
+            os.replace(features_tmp_path, features_path)
+
+            meta = {
+                'version': CACHE_VERSION,
+                'rows': num_rows,
+                'gallery_sha256': tensor_sha256(gps_gallery),
+                'weights_sha256': weights_hash,
+            }
+            meta_tmp_path = tmp_path(meta_path)
+            with open(meta_tmp_path, 'w') as f:
+                json.dump(meta, f, indent=2)
+            os.replace(meta_tmp_path, meta_path)
+
+            location_encoder.train(was_training)
+
+    # copy-on-write mapping: pages are shared with the page cache and torch gets a writable array
+    features = np.load(features_path, mmap_mode='c')
+    return torch.from_numpy(features)
@@ -1,15 +1,29 @@
+import os
+import json
+import pickle
 import torch
 import torch.nn as nn
-from transformers import CLIPModel, AutoProcessor
+from .gallery_cache import module_sha256
+from .files import tmp_path, file_lock
 
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning, module='huggingface_hub.*')
 
+CLIP_MODEL = "openai/clip-vit-large-patch14"
+
 class ImageEncoder(nn.Module):
-    def __init__(self):
+    def __init__(self, clip_model=CLIP_MODEL):
+        """
+        Args:
+            clip_model (str): Hugging Face model id, or a local snapshot directory written by download_clip_snapshot.py
+        """
         super(ImageEncoder, self).__init__()
-        self.CLIP = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
-        self.image_processor = AutoProcessor.from_pretrained("openai/clip-vit-large-patch14")
+        # transformers takes seconds to import, so it is only imported when CLIP is built
+        from transformers import CLIPModel, AutoProcessor
+        local_files_only = os.path.isdir(clip_model)
+        self.clip_model = clip_model
+        self.CLIP = CLIPModel.from_pretrained(clip_model, local_files_only=local_files_only)
+        self.image_processor = AutoProcessor.from_pretrained(clip_model, local_files_only=local_files_only)
         self.mlp = nn.Sequential(nn.Linear(768, 768),
                                  nn.ReLU(),
                                  nn.Linear(768, 512))
@@ -22,7 +36,150 @@ class ImageEncoder(nn.Module):
         x = self.image_processor(images=image, return_tensors="pt")["pixel_values"]
         return x
 
+    def quantize(self):
+        """ Dynamic int8 quantization of the Linear layers of the vision tower, the visual projection and the MLP head.
+        Quantized layers only run on CPU.
+        """
+        torch.ao.quantization.quantize_dynamic(
+            self,
+            qconfig_spec={'CLIP.vision_model', 'CLIP.visual_projection', 'mlp'},
+            mapping={nn.Linear: torch.ao.nn.quantized.dynamic.Linear},
+            dtype=torch.qint8,
+            inplace=True
+        )
+
+    def load_or_quantize(self, path):
+        """ Load the quantized weights of the image layers saved at path, quantizing the layers and saving
+        them there first if they are missing or were made from other CLIP weights, another MLP head or
+        another torch version
+        """
+        key = {
+            'clip_weights': self.clip_weights_id(),
+            'mlp_sha256': module_sha256(self.mlp),
+            'torch_version': str(torch.__version__),
+        }
+        with file_lock(path):
+            if os.path.exists(path):
+                try:
+                    saved = torch.load(path, map_location='cpu', weights_only=True)
+                except pickle.UnpicklingError:
+                    # written by an older version that saved the whole module, rebuilt below
+                    saved = {}
+                if saved.get('key') == key:
+                    # empty quantized layers take the saved weights, quantize_dynamic is not run again
+                    _swap_quantized_linear(self.CLIP.vision_model)
+                    self.CLIP.visual_projection = _quantized_linear(self.CLIP.visual_projection)
+                    _swap_quantized_linear(self.mlp)
+                    self._quantized_modules().load_state_dict(saved['state_dict'])
+                    return
+
+            self.quantize()
+            quantized_tmp_path = tmp_path(path)
+            torch.save({'key': key, 'state_dict': self._quantized_modules().state_dict()}, quantized_tmp_path)
+            os.replace(quantized_tmp_path, path)
+
+    def clip_weights_id(self):
+        """ Identifier of the CLIP weights that is cheap to compute: the commit of the model repository,
+        recorded by Hugging Face or in the snapshot.json of a local snapshot, else the size and modification
+        time of the weight files of a local directory. The weights are only hashed when neither is known.
+        """
+        commit = getattr(self.CLIP.config, '_commit_hash', None)
+        local = os.path.isdir(self.clip_model)
+        snapshot_path = os.path.join(self.clip_model, 'snapshot.json')
+        if commit is None and local and os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                commit = json.load(f).get('commit')
+        if commit is not None:
+            return commit
+        if local:
+            files = sorted(f for f in os.listdir(self.clip_model) if f.endswith(('.safetensors', '.bin')))
+            stats = [os.stat(os.path.join(self.clip_model, f)) for f in files]
+            return [[f, stat.st_size, stat.st_mtime_ns] for f, stat in zip(files, stats)]
+        return module_sha256(nn.ModuleList([self.CLIP.vision_model, self.CLIP.visual_projection]))
+
+    def _quantized_modules(self):
+        return nn.ModuleDict({
+            'vision_model': self.CLIP.vision_model,
+            'visual_projection': self.CLIP.visual_projection,
+            'mlp': self.mlp
+        })
+
     def forward(self, x):
         x = self.CLIP.get_image_features(pixel_values=x)
         x = self.mlp(x)
-        return x
\ No newline at end of file
+        return x
+
+    @torch.no_grad()
+    def export_torchscript(self, path, batch_size=2):
+        """ Trace the vision tower, the visual projection and the MLP head into a frozen TorchScript graph
+        loadable by TracedImageEncoder. The image processor config and a hash of the MLP head are stored
+        in the same file.
+        """
+        tower = _ImageTower(self.CLIP.vision_model, self.CLIP.visual_projection, self.mlp).eval()
+        example = torch.randn(batch_size, 3, 224, 224, device=next(self.mlp.parameters()).device)
+        graph = torch.jit.freeze(torch.jit.trace(tower, example))
+
+        image_processor = getattr(self.image_processor, 'image_processor', self.image_processor)
+        graph_tmp_path = tmp_path(path)
+        torch.jit.save(graph, graph_tmp_path, _extra_files={
+            'preprocessor_config.json': image_processor.to_json_string(),
+            'mlp_sha256': module_sha256(self.mlp)
+        })
+        os.replace(graph_tmp_path, path)
+
+
+class _ImageTower(nn.Module):
+    """ The image path of ImageEncoder.forward, without the text model, for tracing """
+    def __init__(self, vision_model, visual_projection, mlp):
+        super().__init__()
+        self.vision_model = vision_model
+        self.visual_projection = visual_projection
+        self.mlp = mlp
+
+    def forward(self, x):
+        pooled_output = self.vision_model(pixel_values=x)[1]
+        return self.mlp(self.visual_projection(pooled_output))
+
+
+class TracedImageEncoder(nn.Module):
+    """ Image encoder running the TorchScript graph saved by ImageEncoder.export_torchscript,
+    which skips building CLIPModel at startup. The MLP head is part of the graph.
+    """
+    def __init__(self, path, device='cpu'):
+        super().__init__()
+        from transformers import CLIPImageProcessor
+        extra_files = {'preprocessor_config.json': '', 'mlp_sha256': ''}
+        self.graph = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        self.image_processor = CLIPImageProcessor.from_dict(json.loads(extra_files['preprocessor_config.json']))
+        self.mlp_sha256 = _as_str(extra_files['mlp_sha256'])
+        self.path = path
+
+    def preprocess_image(self, image):
+        x = self.image_processor(images=image, return_tensors="pt")["pixel_values"]
+        return x
+
+    def forward(self, x):
+        return self.graph(x)
+
+
+def _quantized_linear(linear):
+    """ Uninitialized dynamic int8 Linear layer of the shape of linear, for loading saved quantized weights """
+    return torch.ao.nn.quantized.dynamic.Linear(
+        linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+
+
+def _swap_quantized_linear(module):
+    """ Replace the Linear layers under module by uninitialized quantized ones, the layout quantize() produces """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, _quantized_linear(child))
+        else:
+            _swap_quantized_linear(child)
+
+
+def _as_str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def torchscript_path(weight_dir, iteration_id):
+    return os.path.join(weight_dir, f"image_encoder_{iteration_id}.torchscript.pt")
\ No newline at end of file
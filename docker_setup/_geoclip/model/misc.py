@@ -1,12 +1,176 @@
+import io
 import os
+import json
+import hashlib
 import torch
 import numpy as np
-import pandas as pd
+from PIL import Image
+from .files import tmp_path
 
 file_dir = os.path.dirname(os.path.realpath(__file__))
 
+KM_PER_DEGREE = 111.32
+REGIONS_DIR = os.path.join(file_dir, "gps_gallery", "regions")
+
 def load_gps_data(csv_file):
-    data = pd.read_csv(csv_file)
-    lat_lon = data[['LAT', 'LON']]
-    gps_tensor = torch.tensor(lat_lon.values, dtype=torch.float32)
-    return gps_tensor
\ No newline at end of file
+    # parsed with numpy rather than pandas, which would otherwise be imported at every server start
+    with open(csv_file) as f:
+        header = f.readline().strip().split(',')
+    lat_lon = np.loadtxt(csv_file, delimiter=',', skiprows=1, ndmin=2,
+                         usecols=(header.index('LAT'), header.index('LON')))
+    gps_tensor = torch.tensor(lat_lon, dtype=torch.float32)
+    return gps_tensor
+
+
+def region_path(region):
+    """ Path of a region given either as a GeoJSON file or as the name of a file in gps_gallery/regions """
+    if os.path.exists(region):
+        return region
+    return os.path.join(REGIONS_DIR, f"{region}.geojson")
+
+
+def load_region(region, names=None):
+    """ Load the polygon rings of a GeoJSON region
+
+    Args:
+        region (str): GeoJSON file or name of a file in gps_gallery/regions
+        names (list): If given, keep only the features whose "name" property is listed (e.g. a list of counties)
+
+    Returns:
+        rings (list): Rings of the region as (lon, lat) arrays, holes included
+    """
+    with open(region_path(region)) as f:
+        data = json.load(f)
+
+    if data['type'] == 'FeatureCollection':
+        features = data['features']
+    elif data['type'] == 'Feature':
+        features = [data]
+    else:
+        features = [{'properties': {}, 'geometry': data}]
+
+    if names is not None:
+        wanted = {name.lower() for name in names}
+        features = [feature for feature in features if str(feature['properties'].get('name', '')).lower() in wanted]
+        if len(features) == 0:
+            raise ValueError(f"None of {names} found in region {region}")
+
+    rings = []
+    for feature in features:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        for polygon in polygons:
+            rings.extend(np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon)
+    return rings
+
+
+def points_in_region(gps, rings):
+    """ Mask of the GPS coordinates of shape (n, 2) that fall inside the rings (even-odd rule) """
+    lat = gps[:, 0].numpy().astype(np.float64)
+    lon = gps[:, 1].numpy().astype(np.float64)
+    inside = np.zeros(len(lat), dtype=bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for ring in rings:
+            x0, y0 = ring[:, 0], ring[:, 1]
+            x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+            for i in range(len(x0)):
+                crosses = (y0[i] > lat) != (y1[i] > lat)
+                crosses &= lon < (x1[i] - x0[i]) * (lat - y0[i]) / (y1[i] - y0[i]) + x0[i]
+                inside ^= crosses
+    return torch.from_numpy(inside)
+
+
+def region_grid(rings, spacing_km):
+    """ Regular grid of GPS coordinates, spacing_km apart, covering the inside of the rings """
+    points = np.concatenate(rings)
+    lon_min, lat_min = points.min(axis=0)
+    lon_max, lat_max = points.max(axis=0)
+
+    lat_step = spacing_km / KM_PER_DEGREE
+    lon_step = spacing_km / (KM_PER_DEGREE * np.cos(np.deg2rad((lat_min + lat_max) / 2)))
+    lat, lon = np.meshgrid(np.arange(lat_min, lat_max, lat_step), np.arange(lon_min, lon_max, lon_step), indexing='ij')
+
+    grid = torch.tensor(np.stack((lat.flatten(), lon.flatten()), axis=1), dtype=torch.float32)
+    return grid[points_in_region(grid, rings)]
+
+
+def restrict_gallery(csv_file, region, cache_dir, names=None, grid_spacing_km=None):
+    """ Keep only the gallery points inside a region, optionally padded with a regular grid
+
+    The restricted gallery is written once to a csv in cache_dir, named after the gallery, the region and
+    a hash of the inputs, so it can be loaded with load_gps_data and gets its own gallery feature cache.
+
+    Args:
+        csv_file (str): Gallery csv with LAT and LON columns
+        region (str): GeoJSON file or name of a file in gps_gallery/regions
+        cache_dir (str): Directory where the restricted gallery is written
+        names (list): Optional list of feature names of the region to keep (e.g. counties)
+        grid_spacing_km (float): If given, add a grid of points spaced this far apart inside the region
+
+    Returns:
+        path (str): Path of the restricted gallery csv
+    """
+    digest = hashlib.sha256()
+    for path in (csv_file, region_path(region)):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(repr((sorted(names) if names else None, grid_spacing_km)).encode())
+
+    gallery_name = os.path.splitext(os.path.basename(csv_file))[0]
+    region_name = os.path.splitext(os.path.basename(region_path(region)))[0]
+    path = os.path.join(cache_dir, f"{gallery_name}_{region_name}_{digest.hexdigest()[:12]}.csv")
+    if os.path.exists(path):
+        return path
+
+    rings = load_region(region, names)
+    gps = load_gps_data(csv_file)
+    gps = gps[points_in_region(gps, rings)]
+    if grid_spacing_km:
+        gps = torch.cat([gps, region_grid(rings, grid_spacing_km)])
+
+    import pandas as pd
+    os.makedirs(cache_dir, exist_ok=True)
+    csv_tmp_path = tmp_path(path)
+    pd.DataFrame(gps.numpy(), columns=['LAT', 'LON']).to_csv(csv_tmp_path, index=False)
+    os.replace(csv_tmp_path, path)
+    return path
+
+def load_image(image):
+    """ Decode an image given as a path, raw bytes, a PIL image or a numpy array (H, W, C) into an RGB PIL image.
+    Tensors are assumed to be already preprocessed and are returned unchanged.
+    """
+    if isinstance(image, torch.Tensor):
+        return image
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    return image.convert("RGB")
+
+
+def local_grid(centers, grid_size, spacing_km):
+    """ Regular grid_size x grid_size grids of coordinates centered on each center, without the center itself
+
+    Args:
+        centers (torch.Tensor): GPS coordinates of shape (..., 2)
+        grid_size (int): Number of points per side of each grid
+        spacing_km (float): Distance between neighbouring grid points in km
+
+    Returns:
+        grid (torch.Tensor): GPS coordinates of shape (..., c * (grid_size**2 - grid_size % 2), 2) for c centers
+    """
+    steps = (torch.arange(grid_size, device=centers.device) - (grid_size - 1) / 2) * spacing_km
+    d_lat, d_lon = torch.meshgrid(steps, steps, indexing='ij')
+    offsets = torch.stack((d_lat.flatten(), d_lon.flatten()), dim=1)
+    offsets = offsets[(offsets != 0).any(dim=1)]
+
+    lat = centers[..., 0].unsqueeze(-1) + offsets[:, 0] / KM_PER_DEGREE
+    km_per_degree_lon = KM_PER_DEGREE * torch.cos(torch.deg2rad(centers[..., 0])).clamp(min=1e-3)
+    lon = centers[..., 1].unsqueeze(-1) + offsets[:, 1] / km_per_degree_lon.unsqueeze(-1)
+
+    lat = lat.clamp(-90, 90)
+    lon = (lon + 180) % 360 - 180
+    return torch.stack((lat, lon), dim=-1).flatten(-3, -2)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import io
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class FastPreprocessor:
+    """ Inference preprocessing matching the CLIP image processor (shortest edge resize with bicubic
+    resampling, center crop, rescale and normalize) within a small tolerance, at a fraction of its cost
+
+    - JPEGs are decoded in draft mode, shrunk by the decoder to the smallest 1/2, 1/4 or 1/8 scale
+      whose shortest edge is still draft_factor times the target size
+    - only the part of the image inside the center crop is resampled, straight to the crop size
+    - the crops are rescaled and normalized as a single uint8 batch
+    """
+
+    def __init__(self, size: int = 224, crop_size: int = 224, mean=CLIP_MEAN, std=CLIP_STD, draft_factor: float = 2.0):
+        self.size = size
+        self.crop_size = crop_size
+        self.draft_factor = draft_factor
+        std = torch.tensor(std).reshape(1, 3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.offset = -torch.tensor(mean).reshape(1, 3, 1, 1) / std
+
+    @classmethod
+    def from_image_processor(cls, image_processor, **kwargs) -> 'FastPreprocessor':
+        """ Settings of a Hugging Face CLIPImageProcessor (or of the CLIPProcessor wrapping it) """
+        image_processor = getattr(image_processor, 'image_processor', image_processor)
+        return cls(
+            size=image_processor.size['shortest_edge'],
+            crop_size=image_processor.crop_size['height'],
+            mean=image_processor.image_mean,
+            std=image_processor.image_std,
+            **kwargs
+        )
+
+    def open(self, image):
+        """ Decode a path, raw bytes, PIL image or numpy array (H, W, C) into an RGB PIL image,
+        letting the JPEG decoder shrink images much larger than needed
+
+        Returns:
+            image (PIL.Image): RGB image
+            original_size (tuple): (width, height) of the image before draft mode
+        """
+        if isinstance(image, (str, os.PathLike)):
+            image = Image.open(image)
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            image = Image.open(io.BytesIO(image))
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+
+        original_size = image.size
+        if image.format == 'JPEG':
+            # no-op for images already decoded, otherwise both sides stay at least as large as requested
+            target = int(self.size * self.draft_factor)
+            image.draft('RGB', (target, target))
+        return image.convert("RGB"), original_size
+
+    def resize_crop(self, image: Image.Image, original_size: tuple = None) -> np.ndarray:
+        """ Shortest edge resize and center crop of an RGB image, as a uint8 array (crop_size, crop_size, 3)
+
+        Args:
+            image (PIL.Image): RGB image, possibly decoded in draft mode
+            original_size (tuple): (width, height) of the image before draft mode, defaults to its size
+        """
+        width, height = original_size or image.size
+        # output size of the reference resize, computed on the full resolution size
+        if width <= height:
+            new_width, new_height = self.size, int(self.size * height / width)
+        else:
+            new_width, new_height = int(self.size * width / height), self.size
+        left = (new_width - self.crop_size) // 2
+        top = (new_height - self.crop_size) // 2
+
+        # the crop window of the resized image, in coordinates of the (possibly drafted) image
+        scale_x, scale_y = image.width / new_width, image.height / new_height
+        box = (left * scale_x, top * scale_y, (left + self.crop_size) * scale_x, (top + self.crop_size) * scale_y)
+        crop = image.resize((self.crop_size, self.crop_size), Image.BICUBIC, box=box, reducing_gap=None)
+        return np.asarray(crop)
+
+    def __call__(self, images: list) -> torch.Tensor:
+        """ Preprocess a list of images accepted by open into pixel values of shape (n, 3, crop_size, crop_size) """
+        crops = [self.resize_crop(*self.open(image)) for image in images]
+
+        pixels = torch.from_numpy(np.stack(crops)).permute(0, 3, 1, 2)
+        return pixels.float() * self.scale + self.offset
@@ -0,0 +1,144 @@
+import os
+import json
+import numpy as np
+import torch
+from .ann_index import features_fingerprint
+from .files import tmp_path, file_lock
+from .scoring import streaming_topk, DEFAULT_CHUNK_SIZE
+
+DTYPES = ('float16', 'int8')
+
+
+def quantize_rows(features: torch.Tensor, dtype: str):
+    """ Quantize a feature matrix to float16, or to int8 with one scale per row
+
+    Returns:
+        values (torch.Tensor): Quantized features of the same shape
+        scales (torch.Tensor | None): Per-row scales of shape (m,) for int8, None for float16
+    """
+    if dtype == 'float16':
+        return features.half(), None
+    if dtype == 'int8':
+        scales = features.abs().amax(dim=1).clamp(min=1e-12) / 127
+        values = torch.round(features / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        return values, scales.float()
+    raise ValueError(f"Unsupported gallery dtype: {dtype}")
+
+
+class QuantizedGallery:
+    """ Low precision copy of the gallery features used for scoring
+
+    Every gallery point is scored with the quantized features, then the rerank best candidates
+    are re-scored with the exact float32 features, so only those rows of the float32 store are read.
+    """
+
+    def __init__(self, values: torch.Tensor, scales: torch.Tensor, features: torch.Tensor, rerank: int = 64,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.values = values
+        self.scales = scales
+        self.features = features
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+
+    @property
+    def dtype(self) -> str:
+        return 'int8' if self.values.dtype == torch.int8 else 'float16'
+
+    @classmethod
+    def build(cls, gallery_features: torch.Tensor, dtype: str, rerank: int = 64, chunk_size: int = 16384) -> 'QuantizedGallery':
+        parts = [
+            quantize_rows(gallery_features[start:start + chunk_size].float().cpu(), dtype)
+            for start in range(0, gallery_features.shape[0], chunk_size)
+        ]
+        values = torch.cat([v for v, _ in parts])
+        scales = torch.cat([s for _, s in parts]) if dtype == 'int8' else None
+        return cls(values, scales, gallery_features, rerank=rerank)
+
+    def save(self, path: str, fingerprint: str) -> None:
+        for suffix, array in (('.npy', self.values), ('.scales.npy', self.scales)):
+            if array is None:
+                continue
+            array_tmp_path = tmp_path(path + suffix)
+            with open(array_tmp_path, 'wb') as f:
+                np.save(f, array.numpy())
+            os.replace(array_tmp_path, path + suffix)
+
+        meta_tmp_path = tmp_path(path + ".json")
+        with open(meta_tmp_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'dtype': self.dtype}, f)
+        os.replace(meta_tmp_path, path + ".json")
+
+    @classmethod
+    def load(cls, path: str, gallery_features: torch.Tensor, fingerprint: str = None, rerank: int = 64,
+             chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'QuantizedGallery | None':
+        """ Load a store saved with save, None if it is missing or was built for other features """
+        if not os.path.exists(path + ".json") or not os.path.exists(path + ".npy"):
+            return None
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if fingerprint is not None and meta.get('fingerprint') != fingerprint:
+            return None
+
+        values = torch.from_numpy(np.load(path + ".npy", mmap_mode='c'))
+        scales = None
+        if meta['dtype'] == 'int8':
+            scales = torch.from_numpy(np.load(path + ".scales.npy"))
+        return cls(values, scales, gallery_features, rerank=rerank)
+
+    @torch.no_grad()
+    def search(self, queries: torch.Tensor, top_k: int, scale: float = 1.0):
+        """ Top k search by inner product, scored in low precision and re-ranked in float32
+
+        float16 features are multiplied natively in half precision. For int8 the queries are quantized
+        per row as well and scored with an int8 x int8 -> int32 matmul. The gallery is scored in chunks
+        of chunk_size rows, see scoring.streaming_topk.
+
+        Args:
+            queries (torch.Tensor): Normalized query features of shape (n, d)
+            top_k (int): Number of results per query
+            scale (float): Factor applied to the similarities, e.g. the model logit scale
+
+        Returns:
+            top_logits (torch.Tensor): Exact scaled similarities of the results, shape (n, k)
+            top_indices (torch.Tensor): Gallery rows of the results, shape (n, k)
+            log_norm (torch.Tensor): Log-sum-exp of the approximate scaled similarities of the gallery, shape (n,)
+        """
+        queries = queries.float().cpu()
+
+        if self.scales is None:
+            half_queries = queries.half()
+
+            def score_chunk(start, end):
+                return scale * (half_queries @ self.values[start:end].t()).float()
+        else:
+            query_values, query_scales = quantize_rows(queries, 'int8')
+            query_scales = scale * query_scales
+
+            def score_chunk(start, end):
+                sims = torch._int_mm(query_values, self.values[start:end].t()).float()
+                return query_scales.unsqueeze(1) * sims * self.scales[start:end]
+
+        num_candidates = min(max(self.rerank, top_k), self.values.shape[0])
+        _, candidates, log_norm = streaming_topk(score_chunk, self.values.shape[0], num_candidates, self.chunk_size)
+        exact = scale * torch.einsum('nd,nrd->nr', queries, self.features[candidates].float().cpu())
+        top = exact.topk(top_k, dim=1)
+
+        return top.values, torch.gather(candidates, 1, top.indices), log_norm
+
+
+def load_quantized_gallery(gallery_features: torch.Tensor, cache_dir: str, cache_name: str,
+                           dtype: str = 'int8', rerank: int = 64, chunk_size: int = DEFAULT_CHUNK_SIZE) -> QuantizedGallery:
+    """ Load the quantized store of a gallery from cache_dir, building and saving it first if it is missing or stale """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported gallery dtype: {dtype}")
+    path = os.path.join(cache_dir, f"{cache_name}.{dtype}")
+    fingerprint = features_fingerprint(gallery_features)
+
+    # workers starting together build the store once, the others wait and load it
+    with file_lock(path):
+        store = QuantizedGallery.load(path, gallery_features, fingerprint=fingerprint, rerank=rerank, chunk_size=chunk_size)
+        if store is None:
+            QuantizedGallery.build(gallery_features, dtype, rerank=rerank).save(path, fingerprint)
+            store = QuantizedGallery.load(path, gallery_features, rerank=rerank, chunk_size=chunk_size)
+
+    return store
@@ -0,0 +1,64 @@
+import torch
+
+DEFAULT_CHUNK_SIZE = 16384
+
+
+@torch.no_grad()
+def streaming_topk(score_chunk, num_rows: int, top_k: int, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """ Top k of logits computed chunk by chunk, keeping a running top k and a running log-sum-exp,
+    so at most chunk_size logits per query are held at a time
+
+    Args:
+        score_chunk (callable): Maps (start, end) to the logits of rows start:end, of shape (n, end - start)
+        num_rows (int): Number of scored rows
+        top_k (int): Number of results per query
+        chunk_size (int): Number of rows scored at a time
+
+    Returns:
+        top_logits (torch.Tensor): Logits of the results, shape (n, k)
+        top_indices (torch.Tensor): Rows of the results, shape (n, k)
+        log_norm (torch.Tensor): Log-sum-exp of the logits of every row, shape (n,)
+    """
+    top_logits, top_indices, log_norm = None, None, None
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        logits = score_chunk(start, end).float()
+        chunk_norm = torch.logsumexp(logits, dim=1)
+        chunk_top = logits.topk(min(top_k, end - start), dim=1)
+
+        if top_logits is None:
+            top_logits, top_indices, log_norm = chunk_top.values, chunk_top.indices + start, chunk_norm
+            continue
+
+        merged_logits = torch.cat([top_logits, chunk_top.values], dim=1)
+        merged_indices = torch.cat([top_indices, chunk_top.indices + start], dim=1)
+        best = merged_logits.topk(min(top_k, merged_logits.shape[1]), dim=1).indices
+        top_logits = torch.gather(merged_logits, 1, best)
+        top_indices = torch.gather(merged_indices, 1, best)
+        log_norm = torch.logaddexp(log_norm, chunk_norm)
+
+    return top_logits, top_indices, log_norm
+
+
+def chunked_topk(queries: torch.Tensor, features: torch.Tensor, top_k: int, scale: float = 1.0,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, transform=None):
+    """ Exact top k search by inner product over features streamed in chunks, see streaming_topk
+
+    Args:
+        queries (torch.Tensor): Normalized query features of shape (n, d)
+        features (torch.Tensor): Gallery features of shape (m, d), or gallery rows turned into features by transform
+        top_k (int): Number of results per query
+        scale (float): Factor applied to the similarities, e.g. the model logit scale
+        chunk_size (int): Number of gallery rows scored at a time
+        transform (callable): Applied to each chunk of rows before scoring, e.g. the location encoder on GPS coordinates
+
+    Returns:
+        top_logits, top_indices, log_norm as returned by streaming_topk
+    """
+    def score_chunk(start, end):
+        chunk = features[start:end].to(queries.device)
+        if transform is not None:
+            chunk = transform(chunk)
+        return scale * (queries @ chunk.to(queries.dtype).t())
+
+    return streaming_topk(score_chunk, features.shape[0], top_k, chunk_size)
@@ -0,0 +1,108 @@
+import time
+import threading
+from contextlib import contextmanager
+from metrics import SHED
+
+# header in which clients can send a shorter timeout than the server one, in seconds
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+
+class Overloaded(Exception):
+    """ Raised by AdmissionController.admit when max_pending requests are already admitted """
+
+
+class DeadlineExceeded(Exception):
+    """ The deadline of a request passed before its inference ran """
+
+
+class ClientDisconnected(Exception):
+    """ The client of a request went away before its inference ran """
+
+
+class Ticket:
+    """ Deadline and cancellation flag of an admitted request, checked before each stage of its inference """
+
+    def __init__(self, timeout: float = None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str = 'disconnected') -> None:
+        """ Abandon the request, its queued work is dropped
+
+        Args:
+            reason (str): 'disconnected' when the client went away, 'deadline' when it stopped waiting
+        """
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+                SHED.inc(reason)
+
+    def remaining(self) -> float | None:
+        """ Seconds left before the deadline, None without one """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self) -> None:
+        """ Raise ClientDisconnected or DeadlineExceeded when the request should not be worked on anymore """
+        if self.reason is None and self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel('deadline')
+        if self.reason == 'disconnected':
+            raise ClientDisconnected()
+        if self.reason == 'deadline':
+            raise DeadlineExceeded()
+
+
+class AdmissionController:
+    """ Bounds the number of inference requests a process holds at once, read, queued or running
+
+    Requests beyond max_pending are rejected before their upload is read, so a burst cannot
+    grow memory with decoded images waiting for CPU time. Each admitted request gets a Ticket
+    whose deadline is the server timeout, or the shorter timeout asked for by the client.
+    """
+
+    def __init__(self, max_pending: int = 32, timeout: float = None):
+        """
+        Args:
+            max_pending (int): Requests admitted at once, 0 for no bound
+            timeout (float): Seconds before an admitted request is dropped, None for no deadline
+        """
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def request_timeout(self, requested: str = None) -> float | None:
+        """ Timeout of a request, the server timeout or a shorter one sent by the client in seconds """
+        try:
+            requested = float(requested) if requested else None
+        except ValueError:
+            requested = None
+        if requested is None or requested <= 0:
+            return self.timeout
+        return min(requested, self.timeout) if self.timeout else requested
+
+    def admit(self, requested_timeout: str = None) -> Ticket:
+        """ Admit a request, raises Overloaded when max_pending requests are admitted already.
+        Every admitted request must be released.
+        """
+        with self._lock:
+            if self.max_pending > 0 and self.pending >= self.max_pending:
+                SHED.inc('queue_full')
+                raise Overloaded()
+            self.pending += 1
+        return Ticket(self.request_timeout(requested_timeout))
+
+    def release(self) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    @contextmanager
+    def admitted(self, requested_timeout: str = None):
+        """ Admit a request for the duration of the block """
+        ticket = self.admit(requested_timeout)
+        try:
+            yield ticket
+        finally:
+            self.release()
@@ -0,0 +1,89 @@
+""" Reading image archives member by member for /predict_archive
+
+Tar archives (optionally gzip, bz2 or xz compressed) are read as a stream, so members are predicted while
+the rest of the upload is still arriving. Zip archives keep their directory at the end, so a zip that is
+not already in a seekable file is spooled to a temporary file first. Either way only the members of the
+batch being predicted are held in memory.
+"""
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+ZIP_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed')
+TAR_CONTENT_TYPES = ('application/x-tar', 'application/gzip', 'application/x-gzip', 'application/x-gtar',
+                     'application/x-bzip2', 'application/x-xz')
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def archive_kind(content_type: str = None, filename: str = None) -> str | None:
+    """ 'zip', 'tar' or None for an unsupported upload, from its content type or else its file name """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in ZIP_CONTENT_TYPES:
+        return 'zip'
+    if content_type in TAR_CONTENT_TYPES:
+        return 'tar'
+
+    filename = (filename or '').lower()
+    if filename.endswith('.zip'):
+        return 'zip'
+    if filename.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        return 'tar'
+    return None
+
+
+def iter_archive(fileobj, kind: str, max_member_bytes: int):
+    """ Yields (name, data, error) for each image member of an archive, in archive order
+
+    Members without an image extension are skipped. Members larger than max_member_bytes are not read,
+    they are yielded with data None and an error message instead.
+    """
+    if kind == 'tar':
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    if member.size > max_member_bytes:
+                        yield member.name, None, f'Image larger than {max_member_bytes} bytes'
+                    else:
+                        yield member.name, archive.extractfile(member).read(), None
+        return
+
+    if not _seekable(fileobj):
+        fileobj = spool(fileobj)
+
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                if info.file_size > max_member_bytes:
+                    yield info.filename, None, f'Image larger than {max_member_bytes} bytes'
+                else:
+                    yield info.filename, archive.read(info), None
+
+
+def spool(fileobj):
+    """ Copy of a file object in a temporary file on disk, positioned at its start """
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(fileobj, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def _seekable(fileobj) -> bool:
+    try:
+        return fileobj.seekable()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def ndjson_predictions(results):
+    """ One JSON line per (name, predictions, error) result, and a last line with the error
+    when the archive turns out to be corrupt halfway through
+    """
+    try:
+        for name, predictions, error in results:
+            record = {'file': name, 'error': error} if error is not None else {'file': name, 'predictions': predictions}
+            yield json.dumps(record) + '\n'
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+        yield json.dumps({'error': f'Invalid archive: {e}'}) + '\n'
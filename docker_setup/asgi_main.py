@@ -0,0 +1,344 @@
+""" Async serving entry point
+
+Uploads are read and responses serialized on the event loop, while inference runs on a bounded
+thread pool through the same load_served_model / predict_image code as main.py.
+
+    uvicorn asgi_main:app --host 0.0.0.0 --port 5000
+"""
+import io
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timing import StartupTimer
+
+TIMER = StartupTimer()
+with TIMER.phase('imports'):
+    from starlette.applications import Starlette
+    from starlette.datastructures import UploadFile
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.background import BackgroundTask
+    from starlette.responses import JSONResponse, Response, StreamingResponse
+    from starlette.routing import Route
+    from model_loader import (
+        load_served_model, configure_torch_threads, warmup_model, create_batcher, create_embedding_cache,
+        predict_image, predict_images, predict_stream
+    )
+    from archive import archive_kind, iter_archive, ndjson_predictions, NDJSON_CONTENT_TYPE
+    import metrics
+    from admission import AdmissionController, Overloaded, DeadlineExceeded, ClientDisconnected, TIMEOUT_HEADER
+    from config import (
+        MAX_BATCH_SIZE, MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW_MS, INFERENCE_WORKERS, REQUEST_REGIONS,
+        IMAGE_ENCODER_DTYPE, IMAGE_ENCODER_BACKEND, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_MB, EMBEDDING_CACHE_PATH,
+        FAST_PREPROCESS, WARMUP_BATCH_SIZES, WARMUP_ROUNDS, LOAD_IN_BACKGROUND,
+        MAX_PENDING_REQUESTS, RETRY_AFTER_S, LOADING_RETRY_AFTER_S, REQUEST_TIMEOUT_S, TORCH_THREADS, TORCH_INTEROP_THREADS,
+        ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_MEMBER_MB
+    )
+
+# seconds between checks for clients that disconnected while their request waits for inference
+DISCONNECT_POLL_S = 0.1
+
+MODEL = None
+BATCHER = None
+CACHE = None
+READY = threading.Event()
+LOAD_ERROR = None
+metrics.Gauge('geoclip_ready', 'Whether the model is loaded and warmed up', fn=lambda: int(READY.is_set()))
+ADMISSION = AdmissionController(MAX_PENDING_REQUESTS, REQUEST_TIMEOUT_S)
+metrics.register_admission_metrics(ADMISSION)
+
+
+def load():
+    global MODEL, BATCHER, CACHE, LOAD_ERROR
+    try:
+        configure_torch_threads(TORCH_THREADS, TORCH_INTEROP_THREADS)
+        MODEL = load_served_model(timer=TIMER)
+        BATCHER = create_batcher(MODEL, MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW_MS)
+        if BATCHER is not None:
+            metrics.register_batcher_metrics(BATCHER)
+        CACHE = create_embedding_cache(
+            EMBEDDING_CACHE_SIZE,
+            max_mb=EMBEDDING_CACHE_MB,
+            persist_path=EMBEDDING_CACHE_PATH,
+            namespace=f"{MODEL.iteration_id}-{IMAGE_ENCODER_BACKEND}-{IMAGE_ENCODER_DTYPE}-{'fast' if FAST_PREPROCESS else 'hf'}"
+        )
+        if CACHE is not None:
+            metrics.register_cache_metrics(CACHE)
+        with TIMER.phase('warmup'):
+            warmup_model(MODEL, WARMUP_BATCH_SIZES, WARMUP_ROUNDS, regions=REQUEST_REGIONS)
+    except Exception as e:
+        LOAD_ERROR = e
+        raise
+    print(TIMER.report(), flush=True)
+    READY.set()
+
+
+if LOAD_IN_BACKGROUND:
+    threading.Thread(target=load, name='model-loader', daemon=True).start()
+else:
+    load()
+
+# with the micro-batcher the pool threads only wait on its futures, so it needs room for a full batch
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=INFERENCE_WORKERS if MICRO_BATCH_SIZE <= 1 else max(INFERENCE_WORKERS, MICRO_BATCH_SIZE),
+    thread_name_prefix='inference'
+)
+
+
+def loading_response():
+    return JSONResponse({'error': 'The model is loading'}, status_code=503, headers={'Retry-After': str(LOADING_RETRY_AFTER_S)})
+
+
+async def run_inference(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, fn, *args)
+
+
+async def run_admitted(request, ticket, fn, *args):
+    """ run_inference, cancelling the ticket when the client disconnects so its queued work is dropped.
+    Returns once the pool thread is done with the request, so its admission is held until then.
+    """
+    task = asyncio.ensure_future(run_inference(fn, *args))
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+        if not task.done() and ticket.reason is None and await request.is_disconnected():
+            ticket.cancel()
+    return task.result()
+
+
+def request_region(request, form):
+    region = request.query_params.get('region') or form.get('region')
+    if region is not None and region not in MODEL.region_galleries:
+        raise ValueError(f'Unknown region: {region}')
+    return region
+
+
+def admitted(handler):
+    """ Admit the request through ADMISSION before its upload is read, the handler receives its ticket """
+    @functools.wraps(handler)
+    async def admitted_handler(request):
+        if not READY.is_set():
+            return loading_response()
+        with ADMISSION.admitted(request.headers.get(TIMEOUT_HEADER)) as ticket:
+            return await handler(request, ticket)
+    return admitted_handler
+
+
+@admitted
+async def predict(request, ticket):
+    form = await request.form()
+    img = form.get('image')
+    if not isinstance(img, UploadFile):
+        return JSONResponse({'error': 'No image provided'}, status_code=400)
+
+    try:
+        region = request_region(request, form)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+    data = io.BytesIO(await img.read())
+    predictions = await run_admitted(request, ticket, predict_image, MODEL, data, 5, BATCHER, region, CACHE, ticket)
+    return JSONResponse({'predictions': predictions})
+
+
+@admitted
+async def predict_batch(request, ticket):
+    form = await request.form(max_files=MAX_BATCH_SIZE + 1)
+    images = [img for img in form.getlist('images') if isinstance(img, UploadFile)]
+    if len(images) == 0:
+        return JSONResponse({'error': 'No images provided'}, status_code=400)
+    if len(images) > MAX_BATCH_SIZE:
+        return JSONResponse({'error': f'Too many images, the maximum batch size is {MAX_BATCH_SIZE}'}, status_code=413)
+
+    try:
+        region = request_region(request, form)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+    data = [io.BytesIO(await img.read()) for img in images]
+    predictions = await run_admitted(request, ticket, predict_images, MODEL, data, 5, region, CACHE, ticket)
+    return JSONResponse({'predictions': predictions})
+
+
+class BodyReader(io.RawIOBase):
+    """ Blocking file object over the request body, for a worker thread to read while the event loop receives it """
+
+    def __init__(self, request, loop):
+        self._chunks = request.stream()
+        self._loop = loop
+        self._buffer = b''
+
+    async def _next_chunk(self):
+        return await self._chunks.__anext__()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) == 0:
+            try:
+                self._buffer = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result()
+            except StopAsyncIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class BodyStreamingResponse(StreamingResponse):
+    """ StreamingResponse of a handler that still reads the request body while it responds
+
+    The base class listens for a disconnect on receive while streaming, which would take the body
+    messages. Here a disconnect surfaces when the body is read instead. The background task also runs
+    when streaming fails.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        finally:
+            if self.background is not None:
+                await self.background()
+
+
+async def predict_archive(request):
+    """ Predictions of the images of a zip or tar archive, sent as the request body or as an "archive"
+    multipart file, streamed back as one NDJSON line per image as each batch is predicted.
+    Starlette iterates the response, reading and predicting the members, on its thread pool.
+    The request stays admitted until the response is complete.
+    """
+    if not READY.is_set():
+        return loading_response()
+    ADMISSION.admit(request.headers.get(TIMEOUT_HEADER))
+    try:
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            form = await request.form()
+            upload = form.get('archive')
+            if not isinstance(upload, UploadFile):
+                ADMISSION.release()
+                return JSONResponse({'error': 'No archive provided'}, status_code=400)
+            fileobj, kind = upload.file, archive_kind(upload.content_type, upload.filename)
+        else:
+            form = {}
+            fileobj, kind = io.BufferedReader(BodyReader(request, asyncio.get_running_loop())), archive_kind(content_type)
+        if kind is None:
+            ADMISSION.release()
+            return JSONResponse({'error': 'Expected a zip or tar archive'}, status_code=415)
+
+        try:
+            region = request_region(request, form)
+        except ValueError as e:
+            ADMISSION.release()
+            return JSONResponse({'error': str(e)}, status_code=400)
+    except BaseException:
+        ADMISSION.release()
+        raise
+
+    members = iter_archive(fileobj, kind, int(ARCHIVE_MAX_MEMBER_MB * 2**20))
+    results = predict_stream(MODEL, members, batch_size=ARCHIVE_BATCH_SIZE, region=region, cache=CACHE)
+    return BodyStreamingResponse(
+        ndjson_predictions(results), media_type=NDJSON_CONTENT_TYPE, background=BackgroundTask(ADMISSION.release)
+    )
+
+
+async def cache_stats(request):
+    if not READY.is_set():
+        return loading_response()
+    if CACHE is None:
+        return JSONResponse({'error': 'The embedding cache is disabled'}, status_code=404)
+    return JSONResponse(CACHE.stats())
+
+
+async def healthz(request):
+    if LOAD_ERROR is not None:
+        return JSONResponse({'status': 'failed', 'error': repr(LOAD_ERROR)}, status_code=500)
+    return JSONResponse({'status': 'ok'})
+
+
+async def readyz(request):
+    if not READY.is_set():
+        return JSONResponse({'status': 'loading'}, status_code=503)
+    return JSONResponse({'status': 'ready'})
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+class RequestMetricsMiddleware:
+    """ Counts and times every request, labelled by route path """
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        endpoint = scope['path'].strip('/') if scope['path'] in self.paths else 'unknown'
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = metrics.start_request(endpoint)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.finish_request(endpoint, status_code, start)
+
+
+async def overloaded(request, exc):
+    return JSONResponse({'error': 'The server is overloaded'}, status_code=503, headers={'Retry-After': str(RETRY_AFTER_S)})
+
+
+async def deadline_exceeded(request, exc):
+    return JSONResponse({'error': 'The request timed out before it was processed'}, status_code=504)
+
+
+async def client_disconnected(request, exc):
+    # nobody reads it, the status only shows up in the request metrics
+    return JSONResponse({'error': 'Client disconnected'}, status_code=499)
+
+
+def shutdown():
+    EXECUTOR.shutdown(wait=False)
+    if CACHE is not None:
+        CACHE.save()
+
+
+ROUTES = [
+    Route('/predict', predict, methods=['POST']),
+    Route('/predict_batch', predict_batch, methods=['POST']),
+    Route('/predict_archive', predict_archive, methods=['POST']),
+    Route('/cache_stats', cache_stats, methods=['GET']),
+    Route('/healthz', healthz, methods=['GET']),
+    Route('/readyz', readyz, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+]
+
+app = Starlette(
+    routes=ROUTES,
+    middleware=[
+        Middleware(RequestMetricsMiddleware, paths=[route.path for route in ROUTES]),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    ],
+    exception_handlers={
+        Overloaded: overloaded,
+        DeadlineExceeded: deadline_exceeded,
+        ClientDisconnected: client_disconnected
+    },
+    on_shutdown=[shutdown]
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,143 @@
+""" CPU serving autotuner: sweeps worker processes x intra-op threads x batch size on this machine
+
+The model is loaded once, configured from config.py as the servers load it (image encoder backend and dtype,
+gallery, preprocessing, refinement), and each configuration forks its workers from it as gunicorn.conf.py does.
+Every worker runs back to back predictions on batches of synthetic JPEGs (decoding and preprocessing
+included) for --duration seconds, and the sweep reports the throughput in images per second and the
+batch latency percentiles of each configuration.
+
+The best configuration is the one with the highest throughput whose p99 latency is within --max-p99-ms
+(the lowest p99 when none is), and is written as the serving profile that config.py and gunicorn.conf.py
+read at startup. Settings given in the environment still take precedence over the profile.
+
+    python autotune.py --workers 1 2 4 8 --batch-sizes 1 4 8 --duration 20 --max-p99-ms 1500
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from model_loader import load_served_model, served_model_settings, synthetic_jpeg
+from config import WEIGHTS_PATH, SERVING_PROFILE_PATH
+
+
+def worker(model, threads: int, batch_size: int, duration: float, image: bytes, barrier, results) -> None:
+    torch.set_num_threads(threads)
+    images = [image] * batch_size
+    model.predict_batch(images, top_k=5)  # warm the allocator for this batch size
+    barrier.wait()
+
+    latencies = []
+    stop_at = time.perf_counter() + duration
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        model.predict_batch(images, top_k=5)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def run_config(model, workers: int, threads: int, batch_size: int, duration: float, image: bytes) -> dict:
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers + 1)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(model, threads, batch_size, duration, image, barrier, results))
+        for _ in range(workers)
+    ]
+    for p in processes: p.start()
+    barrier.wait()
+    start = time.perf_counter()
+    latencies = [latency for _ in processes for latency in results.get()]
+    elapsed = time.perf_counter() - start
+    for p in processes: p.join()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'workers': workers,
+        'threads': threads,
+        'batch_size': batch_size,
+        'throughput_ips': len(latencies) * batch_size / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def thread_counts(workers: int, threads: list, cpu_count: int, oversubscribe: bool) -> list:
+    """ Intra-op thread counts to try with this many workers, by default all cores split evenly and half of that """
+    if threads is None:
+        threads = sorted({max(1, cpu_count // workers), max(1, cpu_count // (2 * workers))})
+    return [t for t in threads if oversubscribe or workers * t <= cpu_count]
+
+
+def best_config(results: list, max_p99_ms: float = None) -> dict:
+    within = [r for r in results if max_p99_ms is None or r['p99_ms'] <= max_p99_ms]
+    if len(within) == 0:
+        return min(results, key=lambda r: r['p99_ms'])
+    return max(within, key=lambda r: r['throughput_ips'])
+
+
+def main() -> None:
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', nargs='+', type=int, default=[w for w in (1, 2, 4, 8) if w <= cpu_count])
+    parser.add_argument('--threads', nargs='+', type=int, default=None, help='intra-op threads per worker')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8])
+    parser.add_argument('--interop-threads', type=int, default=1,
+                        help='inter-op threads written to the profile, the workers only run intra-op parallel kernels')
+    parser.add_argument('--oversubscribe', action='store_true', help='also try workers x threads above the core count')
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds per configuration')
+    parser.add_argument('--max-p99-ms', type=float, default=None, help='latency budget of a batch')
+    parser.add_argument('--image', default=None, help='image to predict on, a synthetic 640x480 JPEG by default')
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--output', default=SERVING_PROFILE_PATH)
+    args = parser.parse_args()
+
+    if torch.cuda.is_available():
+        parser.error('the autotuner sweeps CPU settings, hide the GPU with CUDA_VISIBLE_DEVICES=')
+
+    model = load_served_model(args.weights)
+    if args.image is not None:
+        with open(args.image, 'rb') as f:
+            image = f.read()
+    else:
+        image = synthetic_jpeg()
+
+    results = []
+    print(f"{'workers':>7} {'threads':>7} {'batch':>5} {'img/s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for workers in args.workers:
+        for threads in thread_counts(workers, args.threads, cpu_count, args.oversubscribe):
+            for batch_size in args.batch_sizes:
+                r = run_config(model, workers, threads, batch_size, args.duration, image)
+                results.append(r)
+                print(f"{workers:>7} {threads:>7} {batch_size:>5} {r['throughput_ips']:>8.2f} "
+                      f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f}")
+
+    if len(results) == 0:
+        parser.error('no configuration fits in the cores of this machine, pass --oversubscribe')
+
+    best = best_config(results, args.max_p99_ms)
+    print(f"recommended: {best['workers']} workers x {best['threads']} threads, batch size {best['batch_size']}")
+
+    profile = {
+        'web_workers': best['workers'],
+        'torch_threads': best['threads'],
+        'interop_threads': args.interop_threads,
+        'micro_batch_size': best['batch_size'],
+        # the model the profile was measured on, it only holds for a server loading the same one
+        'model': served_model_settings(),
+        'expected': {key: best[key] for key in ('throughput_ips', 'p50_ms', 'p95_ms', 'p99_ms')},
+        'max_p99_ms': args.max_p99_ms,
+        'cpu_count': cpu_count,
+        'torch_version': torch.__version__,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
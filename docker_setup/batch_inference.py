@@ -0,0 +1,198 @@
+""" Offline batch inference over a directory of images or a csv manifest, written as parquet part files
+
+Images are decoded and preprocessed by --workers DataLoader processes while the model encodes batches of
+--batch-size images. Each output row holds the top-k predictions of an image, and when the manifest has
+LAT and LON columns, the ground truth and the great-circle error of the top-1 prediction in km. Images
+that cannot be decoded get a row with an error message instead.
+
+Once --part-size images are scored they are written to a new part file of the output directory, renamed
+into place when complete, so the directory can be read at any time with pd.read_parquet. An interrupted
+run restarted with the same command skips the images of the part files already written and only scores
+the others.
+
+    python batch_inference.py val_dataset.csv --images-dir imagini/ --output predictions/
+    python batch_inference.py imagini/ --output predictions/ --batch-size 128 --workers 8
+"""
+import os
+import glob
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from torch.utils.data import Dataset, DataLoader
+from _geoclip.model.misc import load_image
+from archive import IMAGE_EXTENSIONS
+from evaluate import haversine_km
+from model_loader import load_model
+from config import WEIGHTS_PATH, FAST_PREPROCESS
+
+# pyarrow skips files starting with _ or . when the output directory is read as a dataset
+RUN_FILE = '_run.json'
+
+
+class ImageDataset(Dataset):
+    """ Preprocessed images of a list of paths, with a flag for the ones that cannot be decoded
+
+    Only the preprocessor is held, not the model, so the DataLoader workers stay small.
+    """
+
+    def __init__(self, paths: list, model):
+        self.paths = paths
+        self.fast_preprocessor = model.fast_preprocessor
+        self.image_processor = model.image_encoder.image_processor
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        try:
+            if self.fast_preprocessor is not None:
+                pixels = self.fast_preprocessor([self.paths[i]])[0]
+            else:
+                pixels = self.image_processor(images=load_image(self.paths[i]), return_tensors='pt')['pixel_values'][0]
+            return i, pixels, True
+        except (OSError, ValueError):
+            return i, torch.zeros(3, 224, 224), False
+
+
+def list_images(source: str, images_dir: str = None) -> pd.DataFrame:
+    """ IMG_FILE, LAT and LON of a csv manifest, or IMG_FILE of the images under a directory
+    with paths relative to it, and the PATH each image is read from
+    """
+    if os.path.isdir(source):
+        files = sorted(
+            os.path.relpath(os.path.join(root, name), source)
+            for root, _, names in os.walk(source) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        data = pd.DataFrame({'IMG_FILE': files})
+        images_dir = source
+    else:
+        data = pd.read_csv(source)
+    data['PATH'] = [os.path.join(images_dir, f) for f in data['IMG_FILE']] if images_dir else data['IMG_FILE']
+    return data
+
+
+def output_schema(top_k: int, ground_truth: bool) -> pa.Schema:
+    fields = [('image', pa.string())]
+    for i in range(1, top_k + 1):
+        fields += [(f'lat_{i}', pa.float32()), (f'lon_{i}', pa.float32()), (f'prob_{i}', pa.float32())]
+    if ground_truth:
+        fields += [('true_lat', pa.float32()), ('true_lon', pa.float32()), ('error_km', pa.float64())]
+    fields.append(('error', pa.string()))
+    return pa.schema(fields)
+
+
+def finished_images(output: str) -> tuple[set, int]:
+    """ Images already in the part files of the output directory, and the number of the next part """
+    for leftover in glob.glob(os.path.join(output, '.part-*.parquet.tmp')):
+        os.remove(leftover)
+    parts = sorted(glob.glob(os.path.join(output, 'part-*.parquet')))
+    done = set()
+    for part in parts:
+        done.update(pq.read_table(part, columns=['image']).column('image').to_pylist())
+    next_part = int(os.path.basename(parts[-1])[len('part-'):-len('.parquet')]) + 1 if parts else 0
+    return done, next_part
+
+
+def write_part(output: str, number: int, rows: dict, schema: pa.Schema) -> None:
+    name = f'part-{number:05d}.parquet'
+    tmp_path = os.path.join(output, f'.{name}.tmp')
+    pq.write_table(pa.Table.from_pydict(rows, schema=schema), tmp_path)
+    os.replace(tmp_path, os.path.join(output, name))
+
+
+def check_run(output: str, settings: dict) -> None:
+    """ Record the settings of the run in the output directory, or check that they match the recorded ones """
+    path = os.path.join(output, RUN_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            recorded = json.load(f)
+        if recorded != settings:
+            raise SystemExit(f'{output} holds the output of a run with other settings {recorded}, use another --output')
+        return
+    with open(path, 'w') as f:
+        json.dump(settings, f, indent=2)
+
+
+@torch.no_grad()
+def run(model, data: pd.DataFrame, output: str, top_k: int, batch_size: int, workers: int, part_size: int) -> int:
+    """ Score the images of data that are not in the output directory yet, returns the number scored """
+    ground_truth = 'LAT' in data.columns and 'LON' in data.columns
+    schema = output_schema(top_k, ground_truth)
+    done, next_part = finished_images(output)
+    todo = data[~data['IMG_FILE'].isin(done)].reset_index(drop=True)
+    print(f'{len(data)} images, {len(data) - len(todo)} already scored, {len(todo)} to score')
+
+    loader = DataLoader(
+        ImageDataset(todo['PATH'].tolist(), model), batch_size=batch_size, num_workers=workers,
+        pin_memory=str(model.device).startswith('cuda'),
+    )
+    rows = {name: [] for name in schema.names}
+    pending = 0
+    for indices, pixels, decoded in loader:
+        indices = indices.numpy()
+        gps = np.full((len(indices), top_k, 2), np.nan, dtype=np.float32)
+        prob = np.full((len(indices), top_k), np.nan, dtype=np.float32)
+        if decoded.any():
+            image_features = model.encode_images(pixels[decoded])
+            top_gps, top_prob = model.predict_from_features(image_features, top_k)
+            gps[decoded.numpy()], prob[decoded.numpy()] = top_gps.cpu().numpy(), top_prob.cpu().numpy()
+
+        batch = todo.iloc[indices]
+        rows['image'] += batch['IMG_FILE'].tolist()
+        for i in range(top_k):
+            rows[f'lat_{i + 1}'] += gps[:, i, 0].tolist()
+            rows[f'lon_{i + 1}'] += gps[:, i, 1].tolist()
+            rows[f'prob_{i + 1}'] += prob[:, i].tolist()
+        if ground_truth:
+            true_gps = batch[['LAT', 'LON']].to_numpy(dtype=np.float32)
+            error_km = haversine_km(torch.from_numpy(gps[:, 0]), torch.from_numpy(true_gps)).numpy()
+            rows['true_lat'] += true_gps[:, 0].tolist()
+            rows['true_lon'] += true_gps[:, 1].tolist()
+            rows['error_km'] += error_km.tolist()
+        rows['error'] += [None if ok else 'Cannot decode the image' for ok in decoded.tolist()]
+
+        pending += len(indices)
+        if pending >= part_size:
+            write_part(output, next_part, rows, schema)
+            print(f'part {next_part}: {pending} images')
+            rows = {name: [] for name in schema.names}
+            next_part, pending = next_part + 1, 0
+
+    if pending > 0:
+        write_part(output, next_part, rows, schema)
+        print(f'part {next_part}: {pending} images')
+    return len(todo)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='csv manifest with IMG_FILE (and LAT, LON) columns, or a directory of images')
+    parser.add_argument('--images-dir', default=None, help='directory the IMG_FILE paths of the manifest are relative to')
+    parser.add_argument('--output', required=True, help='directory of the parquet part files')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1), help='decoding and preprocessing processes')
+    parser.add_argument('--part-size', type=int, default=10000, help='images per part file, the work lost by an interruption')
+    parser.add_argument('--fast-preprocess', action=argparse.BooleanOptionalAction, default=FAST_PREPROCESS)
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    args = parser.parse_args()
+
+    data = list_images(args.source, args.images_dir)
+    os.makedirs(args.output, exist_ok=True)
+    check_run(args.output, {
+        'source': os.path.abspath(args.source),
+        'top_k': args.top_k,
+        'fast_preprocess': args.fast_preprocess,
+        'weights': os.path.abspath(args.weights),
+    })
+
+    model = load_model(args.weights, fast_preprocess=args.fast_preprocess)
+    run(model, data, args.output, args.top_k, args.batch_size, args.workers, args.part_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """ Queues single-item requests and runs them through batch_fn in batches
+
+    A batch is closed when it reaches max_batch_size items or when max_wait_ms has passed
+    since its first item arrived. batch_fn receives a list of items and must return
+    a list with one result per item, in the same order.
+
+    Items whose future was cancelled, or whose ticket check raises (see admission.Ticket),
+    are dropped from the batch before it runs.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 8, max_wait_ms: float = 5.0):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._start()
+        if hasattr(os, 'register_at_fork'):
+            # threads do not survive fork, so workers forked by a pre-fork server start their own
+            os.register_at_fork(after_in_child=self._start)
+
+    def _start(self) -> None:
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item, ticket=None) -> Future:
+        future = Future()
+        self._queue.put((item, future, ticket))
+        return future
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = []
+            for item, future, ticket in self._next_batch():
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if ticket is not None:
+                        ticket.check()
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                batch.append((item, future))
+            if len(batch) == 0:
+                continue
+
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,83 @@
+""" Recall and latency of the IVF gallery index against exact search
+
+Queries are the image features of the images in --images, or noisy gallery features when no directory is given.
+
+    python bench_ann.py --images val_images/ --nlist 1024 --nprobe 4 8 16 32 64 --top-k 5
+"""
+import os
+import json
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from model_loader import load_model
+from config import WEIGHTS_PATH
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def load_queries(model, images_dir: str, num_queries: int, batch_size: int = 16) -> torch.Tensor:
+    if images_dir is None:
+        rows = torch.randint(model.gallery_features.shape[0], (num_queries,))
+        noisy = model.gallery_features[rows].float() + 0.05 * torch.randn(num_queries, model.gallery_features.shape[1])
+        return F.normalize(noisy, dim=1)
+
+    paths = sorted(
+        os.path.join(images_dir, name) for name in os.listdir(images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:num_queries]
+    features = [
+        model.encode_images([Image.open(path) for path in paths[start:start + batch_size]]).cpu()
+        for start in range(0, len(paths), batch_size)
+    ]
+    return torch.cat(features)
+
+
+def exact_search(model, queries: torch.Tensor, top_k: int):
+    logits = model.logit_scale.exp().item() * (queries @ model.gallery_features.cpu().t())
+    return logits.topk(top_k, dim=1).indices
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=None, help='directory of query images')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', nargs='+', type=int, default=[4, 8, 16, 32, 64])
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--output', default='bench_ann.json')
+    args = parser.parse_args()
+
+    model = load_model(args.weights)
+    queries = load_queries(model, args.images, args.num_queries)
+    scale = model.logit_scale.exp().item()
+
+    start = time.perf_counter()
+    exact = [exact_search(model, query.unsqueeze(0), args.top_k)[0] for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    model.load_ann_index(nlist=args.nlist)
+    index = model.gallery_index
+
+    results = [{'method': 'exact', 'ms_per_query': exact_ms, 'recall': 1.0}]
+    print(f"{'method':>12} {'ms/query':>10} {'recall@' + str(args.top_k):>10}")
+    print(f"{'exact':>12} {exact_ms:>10.2f} {1.0:>10.3f}")
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        found = [index.search(query.unsqueeze(0), args.top_k, scale=scale, nprobe=nprobe)[1][0] for query in queries]
+        ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        recall = sum(
+            len(set(a.tolist()) & set(b.tolist())) for a, b in zip(exact, found)
+        ) / (len(queries) * args.top_k)
+        results.append({'method': f'ivf{args.nlist}', 'nprobe': nprobe, 'ms_per_query': ms, 'recall': recall})
+        print(f"{'nprobe=' + str(nprobe):>12} {ms:>10.2f} {recall:>10.3f}")
+
+    with open(args.output, 'w') as f:
+        json.dump({'nlist': args.nlist, 'top_k': args.top_k, 'num_queries': len(queries), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+""" Latency / throughput of /predict inference with the micro-batching scheduler
+
+Runs closed-loop clients in-process against the model for every (batching window, concurrency) pair
+and reports p50/p99 latency, throughput and the mean batch size. A window of 'off' runs without the scheduler.
+
+    python bench_batching.py image.jpg --windows off 0 2 5 10 20 --concurrency 1 4 8 16 --duration 30
+"""
+import io
+import json
+import argparse
+import threading
+import time
+import numpy as np
+from batching import MicroBatcher
+from model_loader import load_model, predict_batched, predict_image
+from config import WEIGHTS_PATH
+
+
+def run_config(model, image_bytes: bytes, window_ms, max_batch_size: int, concurrency: int, duration: float) -> dict:
+    batch_sizes = []
+
+    def batch_fn(items):
+        batch_sizes.append(len(items))
+        return predict_batched(model, items)
+
+    batcher = None
+    if window_ms is not None:
+        batcher = MicroBatcher(batch_fn, max_batch_size=max_batch_size, max_wait_ms=window_ms)
+
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client():
+        local = []
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            predict_image(model, io.BytesIO(image_bytes), batcher=batcher)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'window_ms': window_ms,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 1.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image', help='image sent by every simulated request')
+    parser.add_argument('--windows', nargs='+', default=['off', '0', '2', '5', '10', '20'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8, 16])
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per configuration')
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--output', default='bench_batching.json')
+    args = parser.parse_args()
+
+    model = load_model(args.weights)
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+    predict_image(model, io.BytesIO(image_bytes))  # warmup
+
+    results = []
+    print(f"{'window':>8} {'conc':>5} {'rps':>8} {'p50 ms':>9} {'p99 ms':>9} {'batch':>6}")
+    for window in args.windows:
+        window_ms = None if window == 'off' else float(window)
+        for concurrency in args.concurrency:
+            r = run_config(model, image_bytes, window_ms, args.max_batch_size, concurrency, args.duration)
+            results.append(r)
+            print(f"{window:>8} {concurrency:>5} {r['throughput_rps']:>8.2f} {r['p50_ms']:>9.1f} "
+                  f"{r['p99_ms']:>9.1f} {r['mean_batch_size']:>6.2f}")
+
+    with open(args.output, 'w') as f:
+        json.dump({'max_batch_size': args.max_batch_size, 'duration_s': args.duration, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+""" Microbenchmarks of the GeoCLIP components across batch sizes and thread counts
+
+Each component is timed in isolation: the wall time (median, min and mean of --repeat runs after
+--warmup runs) and the peak memory above the level before the benchmark, the RSS sampled every
+millisecond on CPU or the allocator peak on CUDA.
+
+With --baseline, results are compared with a previous output file. A component is flagged as a
+regression when its median time or its peak memory grew by more than --time-tolerance or
+--memory-tolerance, and the script exits with status 1.
+
+    python bench_model.py --output bench_model_base.json
+    python bench_model.py --baseline bench_model_base.json --threads 1 4 --batch-sizes 1 8 32
+"""
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import torch
+from _geoclip.model.location_encoder import equal_earth_projection
+from _geoclip.model.rff.functional import gaussian_encoding
+from model_loader import load_model, synthetic_jpeg
+from metrics import process_rss_bytes
+from config import WEIGHTS_PATH
+
+IMAGE_COMPONENTS = ('image_encoder', 'preprocess', 'predict')
+LOCATION_COMPONENTS = ('equal_earth_projection', 'gaussian_encoding', 'location_encoder_capsule')
+GALLERY_COMPONENTS = ('location_encoder_gallery',)
+COMPONENTS = LOCATION_COMPONENTS + GALLERY_COMPONENTS + IMAGE_COMPONENTS
+
+
+class PeakMemory:
+    """ Peak memory in bytes above the level at entry, of the CUDA allocator or of the process RSS """
+
+    def __init__(self, device: str, interval: float = 0.001):
+        self.cuda = str(device).startswith('cuda')
+        self.interval = interval
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._base = torch.cuda.memory_allocated()
+            return self
+
+        self._base = self._peak = process_rss_bytes()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, process_rss_bytes())
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            torch.cuda.synchronize()
+            self.peak_bytes = torch.cuda.max_memory_allocated() - self._base
+            return
+        self._stop.set()
+        self._sampler.join()
+        self.peak_bytes = max(self._peak, process_rss_bytes()) - self._base
+
+
+def make_workload(model, component: str, batch_size: int, image_bytes: bytes):
+    """ A no-argument callable running the component once on a batch of batch_size inputs """
+    device = model.device
+    gps = torch.stack([torch.empty(batch_size).uniform_(-90, 90), torch.empty(batch_size).uniform_(-180, 180)], dim=1)
+    gps = gps.to(device)
+    capsule = model.location_encoder.LocEnc0
+
+    if component == 'equal_earth_projection':
+        return lambda: equal_earth_projection(gps)
+    if component == 'gaussian_encoding':
+        projected = equal_earth_projection(gps)
+        b = capsule.capsule[0].b
+        return lambda: gaussian_encoding(projected, b)
+    if component == 'location_encoder_capsule':
+        projected = equal_earth_projection(gps)
+        return lambda: capsule(projected)
+    if component == 'location_encoder_gallery':
+        # the whole gallery, in the chunks the uncached gallery search encodes it in
+        gallery = model.gps_gallery.to(device)
+        chunk_size = model.scoring_chunk_size
+        return lambda: [model.location_encoder(gallery[start:start + chunk_size]) for start in range(0, len(gallery), chunk_size)]
+    if component == 'image_encoder':
+        pixels = torch.randn(batch_size, 3, 224, 224, device=device)
+        return lambda: model.image_encoder(pixels)
+    if component == 'preprocess':
+        return lambda: model.preprocess_images([image_bytes] * batch_size)
+    if component == 'predict':
+        return lambda: model.predict_batch([image_bytes] * batch_size, top_k=5)
+    raise ValueError(f'Unknown component: {component}')
+
+
+@torch.no_grad()
+def run_benchmark(model, component: str, batch_size: int, threads: int, image_bytes: bytes,
+                  warmup: int, repeat: int) -> dict:
+    torch.set_num_threads(threads)
+    workload = make_workload(model, component, batch_size, image_bytes)
+    synchronize = torch.cuda.synchronize if str(model.device).startswith('cuda') else lambda: None
+
+    for _ in range(warmup):
+        workload()
+    synchronize()
+
+    times_ms = []
+    with PeakMemory(model.device) as memory:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            workload()
+            synchronize()
+            times_ms.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'component': component,
+        'batch_size': batch_size,
+        'threads': threads,
+        'median_ms': float(np.median(times_ms)),
+        'min_ms': float(np.min(times_ms)),
+        'mean_ms': float(np.mean(times_ms)),
+        'peak_memory_bytes': int(memory.peak_bytes),
+    }
+
+
+def find_regressions(results: list, baseline: dict, time_tolerance: float, memory_tolerance: float,
+                     memory_slack_bytes: int = 16 * 2 ** 20) -> list:
+    """ Results slower or using more memory than the same benchmark of the baseline,
+    memory growth below memory_slack_bytes is ignored as sampling noise
+    """
+    def key(result):
+        return result['component'], result['batch_size'], result['threads']
+
+    previous = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get(key(result))
+        if base is None:
+            continue
+        reasons = []
+        if result['median_ms'] > base['median_ms'] * (1 + time_tolerance):
+            reasons.append(f"median {base['median_ms']:.2f} -> {result['median_ms']:.2f} ms")
+        memory_growth = result['peak_memory_bytes'] - base['peak_memory_bytes']
+        if memory_growth > max(base['peak_memory_bytes'] * memory_tolerance, memory_slack_bytes):
+            reasons.append(f"peak memory {base['peak_memory_bytes'] / 2**20:.1f} -> {result['peak_memory_bytes'] / 2**20:.1f} MB")
+        if reasons:
+            regressions.append({**result, 'reasons': reasons})
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=list(COMPONENTS))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32], help='images per batch')
+    parser.add_argument('--location-batch-sizes', nargs='+', type=int, default=[1, 1024, 16384],
+                        help='GPS coordinates per batch of the location components')
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()])
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--gallery-repeat', type=int, default=3, help='runs of the whole gallery encoding, which takes seconds on CPU')
+    parser.add_argument('--image', default=None, help='image used by preprocess and predict, a synthetic 640x480 JPEG by default')
+    parser.add_argument('--fast-preprocess', action='store_true')
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--baseline', default=None, help='output of a previous run to compare with')
+    parser.add_argument('--time-tolerance', type=float, default=0.10)
+    parser.add_argument('--memory-tolerance', type=float, default=0.10)
+    parser.add_argument('--output', default='bench_model.json')
+    args = parser.parse_args()
+
+    model = load_model(args.weights, fast_preprocess=args.fast_preprocess)
+    if args.image is not None:
+        with open(args.image, 'rb') as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = synthetic_jpeg()
+
+    results = []
+    print(f"{'component':>26} {'batch':>6} {'threads':>7} {'median ms':>10} {'min ms':>9} {'peak MB':>8}")
+    for component in args.components:
+        warmup, repeat = args.warmup, args.repeat
+        if component in GALLERY_COMPONENTS:
+            batch_sizes = [len(model.gps_gallery)]
+            warmup, repeat = min(warmup, 1), args.gallery_repeat
+        elif component in LOCATION_COMPONENTS:
+            batch_sizes = args.location_batch_sizes
+        else:
+            batch_sizes = args.batch_sizes
+
+        for threads in args.threads:
+            for batch_size in batch_sizes:
+                r = run_benchmark(model, component, batch_size, threads, image_bytes, warmup, repeat)
+                results.append(r)
+                print(f"{component:>26} {batch_size:>6} {threads:>7} {r['median_ms']:>10.2f} {r['min_ms']:>9.2f} "
+                      f"{r['peak_memory_bytes'] / 2**20:>8.1f}")
+
+    output = {
+        'device': str(model.device),
+        'fast_preprocess': args.fast_preprocess,
+        'torch_version': torch.__version__,
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.time_tolerance, args.memory_tolerance)
+        output['baseline'] = args.baseline
+        output['regressions'] = regressions
+        for r in regressions:
+            print(f"REGRESSION {r['component']} batch {r['batch_size']} threads {r['threads']}: {'; '.join(r['reasons'])}")
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import json
+
+
+def _load_serving_profile(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+WEIGHTS_PATH = "_geoclip/model/weights"
+# CLIP is loaded from the local snapshot written by download_clip_snapshot.py when it exists
+CLIP_SNAPSHOT_PATH = "_geoclip/model/weights/clip-vit-large-patch14"
+CLIP_MODEL_PATH = os.environ.get("CLIP_MODEL_PATH") or (
+    CLIP_SNAPSHOT_PATH if os.path.isdir(CLIP_SNAPSHOT_PATH) else "openai/clip-vit-large-patch14"
+)
+# serving profile written by autotune.py for this machine, it replaces the defaults of the settings it holds
+SERVING_PROFILE_PATH = os.environ.get("SERVING_PROFILE_PATH", "serving_profile.json")
+SERVING_PROFILE = _load_serving_profile(SERVING_PROFILE_PATH)
+# torch intra-op and inter-op thread pools of the process, 0 keeps the torch default
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", SERVING_PROFILE.get("torch_threads", 0)))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", SERVING_PROFILE.get("interop_threads", 0)))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))
+MICRO_BATCH_SIZE = int(os.environ.get("MICRO_BATCH_SIZE", SERVING_PROFILE.get("micro_batch_size", 8)))
+MICRO_BATCH_WINDOW_MS = float(os.environ.get("MICRO_BATCH_WINDOW_MS", 5))
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 2))
+# IVF index over the gallery features, ANN_NLIST=0 keeps exact search
+ANN_NLIST = int(os.environ.get("ANN_NLIST", 0))
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 32))
+# coarse-to-fine refinement of the gallery predictions, REFINE_ROUNDS=0 disables it
+REFINE_ROUNDS = int(os.environ.get("REFINE_ROUNDS", 0))
+REFINE_CANDIDATES = int(os.environ.get("REFINE_CANDIDATES", 8))
+REFINE_GRID_SIZE = int(os.environ.get("REFINE_GRID_SIZE", 5))
+REFINE_SPACING_KM = float(os.environ.get("REFINE_SPACING_KM", 10.0))
+# region restricted galleries: GALLERY_REGION replaces the main gallery for the whole deployment,
+# REQUEST_REGIONS are loaded next to it and picked per request with the "region" parameter
+GALLERY_REGION = os.environ.get("GALLERY_REGION") or None
+GALLERY_REGION_NAMES = [name for name in os.environ.get("GALLERY_REGION_NAMES", "").split(",") if name] or None
+GALLERY_GRID_KM = float(os.environ.get("GALLERY_GRID_KM", 0)) or None
+REQUEST_REGIONS = [region for region in os.environ.get("REQUEST_REGIONS", "").split(",") if region]
+# precision of the gallery features used for scoring: float32, float16 or int8 (float32 re-ranked)
+GALLERY_DTYPE = os.environ.get("GALLERY_DTYPE", "float32")
+GALLERY_RERANK = int(os.environ.get("GALLERY_RERANK", 64))
+# precision of the image encoder: float32, or int8 for dynamic quantization of its Linear layers (CPU only)
+IMAGE_ENCODER_DTYPE = os.environ.get("IMAGE_ENCODER_DTYPE", "float32")
+# eager runs CLIPModel, torchscript runs the graph written by export_image_encoder.py
+IMAGE_ENCODER_BACKEND = os.environ.get("IMAGE_ENCODER_BACKEND", "eager")
+# cache of image features keyed by the hash of the uploaded bytes, EMBEDDING_CACHE_SIZE=0 disables it
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_MB = float(os.environ.get("EMBEDDING_CACHE_MB", 0)) or None
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH") or None
+# gallery rows scored at a time, bounds the scoring memory to batch size x SCORING_CHUNK_SIZE logits
+SCORING_CHUNK_SIZE = int(os.environ.get("SCORING_CHUNK_SIZE", 16384))
+# pre-fork serving (gunicorn.conf.py): SHARE_MODEL_MEMORY=1 moves the model to shared memory before workers fork,
+# it needs a /dev/shm larger than the model and galleries (docker run --shm-size=2g, shm_size in compose)
+SHARE_MODEL_MEMORY = os.environ.get("SHARE_MODEL_MEMORY", "0") == "1"
+# FAST_PREPROCESS=1: draft mode JPEG decoding and cropped resampling instead of the Hugging Face image processor,
+# approximate, check it with evaluate.py preprocess-parity on your images before enabling it
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "0") == "1"
+# synthetic batches of each size run WARMUP_ROUNDS times before the server reports ready on /readyz
+WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", f"1,{MICRO_BATCH_SIZE}").split(",") if size]
+WARMUP_ROUNDS = int(os.environ.get("WARMUP_ROUNDS", 2))
+# load and warm the model in a background thread, /healthz answers meanwhile and inference waits for /readyz
+LOAD_IN_BACKGROUND = os.environ.get("LOAD_IN_BACKGROUND", "0") == "1"
+# admission control: inference requests beyond MAX_PENDING_REQUESTS per process (read, queued or running) get 503
+# with Retry-After RETRY_AFTER_S (LOADING_RETRY_AFTER_S while the model is loading), MAX_PENDING_REQUESTS=0 disables
+# the bound. Queued work is dropped after REQUEST_TIMEOUT_S, or the shorter X-Request-Timeout sent by the client,
+# REQUEST_TIMEOUT_S=0 disables the deadline
+MAX_PENDING_REQUESTS = int(os.environ.get("MAX_PENDING_REQUESTS", 32))
+RETRY_AFTER_S = int(os.environ.get("RETRY_AFTER_S", 1))
+LOADING_RETRY_AFTER_S = int(os.environ.get("LOADING_RETRY_AFTER_S", 10))
+REQUEST_TIMEOUT_S = float(os.environ.get("REQUEST_TIMEOUT_S", 30)) or None
+# /predict_archive: images predicted per batch, and the largest archive member read
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 16))
+ARCHIVE_MAX_MEMBER_MB = float(os.environ.get("ARCHIVE_MAX_MEMBER_MB", 20))
@@ -0,0 +1,39 @@
+""" Save a local snapshot of the CLIP model and image processor, so the server starts offline
+without resolving openai/clip-vit-large-patch14 through the Hugging Face cache or the network
+
+The server loads the snapshot from CLIP_SNAPSHOT_PATH when it exists, or from CLIP_MODEL_PATH.
+The resolved commit of the model repository is recorded in snapshot.json.
+
+    python download_clip_snapshot.py --revision main
+"""
+import os
+import json
+import argparse
+from _geoclip.model.image_encoder import CLIP_MODEL
+from config import CLIP_SNAPSHOT_PATH
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=CLIP_MODEL)
+    parser.add_argument('--revision', default='main', help='branch, tag or commit of the model repository')
+    parser.add_argument('--output', default=CLIP_SNAPSHOT_PATH)
+    args = parser.parse_args()
+
+    from transformers import CLIPModel, AutoProcessor
+    model = CLIPModel.from_pretrained(args.model, revision=args.revision)
+    processor = AutoProcessor.from_pretrained(args.model, revision=args.revision)
+
+    model.save_pretrained(args.output, safe_serialization=True)
+    processor.save_pretrained(args.output)
+    with open(os.path.join(args.output, 'snapshot.json'), 'w') as f:
+        json.dump({
+            'model': args.model,
+            'revision': args.revision,
+            'commit': getattr(model.config, '_commit_hash', None)
+        }, f, indent=2)
+    print(f"saved {args.model}@{args.revision} to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
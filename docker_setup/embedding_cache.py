@@ -0,0 +1,192 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+import torch
+
+
+class EmbeddingCache:
+    """ LRU cache of image features keyed by the sha256 of the uploaded image bytes
+
+    Entries are evicted least recently used first once there are more than max_entries of them
+    or they take more than max_bytes. Concurrent get_or_compute calls for the same key run
+    compute once and the other callers wait for its result.
+
+    When persist_path is set the cache is loaded from it at startup and written back by save,
+    merged with the entries other processes saved there in the meantime. The namespace identifies
+    the model that produced the features, a file saved under another namespace is ignored.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = None, persist_path: str = None, namespace: str = ''):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist_path = persist_path
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        if persist_path is not None and os.path.exists(persist_path):
+            self._load(persist_path)
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        with self._lock:
+            features = self._entries.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key: str, features: torch.Tensor) -> None:
+        # callers pass rows of a batch, a copy keeps the entry from holding on to the whole batch
+        features = features.detach().cpu().clone()
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = features
+            self.num_bytes += features.nbytes
+            self._evict()
+
+    def get_or_compute(self, key: str, compute, timeout: float = None, retry_on: tuple = ()) -> torch.Tensor:
+        """ Cached features of key, calling compute to produce them on a miss
+
+        Args:
+            timeout (float): Seconds to wait for the features of a concurrent call for the same key, after which
+                concurrent.futures.TimeoutError is raised, None to wait until they are computed
+            retry_on (tuple): Exceptions of the concurrent call that concern only its caller, such as its request
+                being abandoned, after which the features are computed here instead of raising them
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                features = self._entries.get(key)
+                if features is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return features
+
+                future = self._pending.get(key)
+                if future is None:
+                    future = self._pending[key] = Future()
+                    self.misses += 1
+                    break
+
+            try:
+                features = future.result(timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+            except retry_on:
+                continue
+            with self._lock:
+                self.hits += 1
+            return features
+
+        try:
+            features = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        self.put(key, features)
+        with self._lock:
+            del self._pending[key]
+        future.set_result(features)
+        return features
+
+    def _evict(self) -> None:
+        while len(self._entries) > 0 and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self.num_bytes > self.max_bytes)
+        ):
+            _, features = self._entries.popitem(last=False)
+            self.num_bytes -= features.nbytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.num_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def save(self) -> None:
+        """ Write the entries to persist_path, least recently used first, after the entries already saved there
+        by other processes, keeping the most recent ones within max_entries and max_bytes
+        """
+        if self.persist_path is None:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.persist_path)), exist_ok=True)
+        # pre-forked workers each save their own cache, one at a time and each into a temporary file of its own
+        with _file_lock(self.persist_path + ".lock"):
+            merged = OrderedDict(self._read(self.persist_path))
+            for key, features in entries:
+                merged.pop(key, None)
+                merged[key] = features
+
+            keys, kept, num_bytes = [], [], 0
+            for key, features in reversed(merged.items()):
+                if len(keys) >= self.max_entries:
+                    break
+                if self.max_bytes is not None and num_bytes + features.nbytes > self.max_bytes:
+                    break
+                keys.append(key)
+                kept.append(features)
+                num_bytes += features.nbytes
+            keys.reverse()
+            kept.reverse()
+
+            tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+            features = torch.stack(kept) if len(kept) > 0 else torch.empty(0)
+            torch.save({'namespace': self.namespace, 'keys': keys, 'features': features}, tmp_path)
+            os.replace(tmp_path, self.persist_path)
+
+    def _read(self, path: str) -> list:
+        """ (key, features) pairs saved at path under this namespace, least recently used first """
+        if not os.path.exists(path):
+            return []
+        saved = torch.load(path, map_location='cpu', weights_only=True)
+        if saved['namespace'] != self.namespace:
+            return []
+        return list(zip(saved['keys'], saved['features']))
+
+    def _load(self, path: str) -> None:
+        for key, features in self._read(path):
+            self._entries[key] = features.clone()
+            self.num_bytes += features.nbytes
+        self._evict()
+        self.evictions = 0
+
+
+@contextmanager
+def _file_lock(path: str):
+    """ Exclusive lock between processes, held for the duration of the block (not taken where fcntl is missing) """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
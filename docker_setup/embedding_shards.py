@@ -0,0 +1,112 @@
+""" Image embeddings stored as fixed-size .npy shards, written by export_embeddings.py
+
+A shard directory holds, for each kind of embedding, shards of shard_size rows named {kind}-00000.npy,
+{kind}-00001.npy and so on (the last one shorter), an index.csv with the IMG_FILE (and LAT, LON) of each
+image and the shard and row its embeddings are in, and a meta.json with the settings of the export.
+
+    clip     the 768-d CLIPModel.get_image_features output
+    geoclip  the 512-d output of the GeoCLIP mlp head, not normalized
+
+The shards are opened memory-mapped, so only the rows that are read are loaded from disk.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+KINDS = {'clip': 768, 'geoclip': 512}
+INDEX_FILE = 'index.csv'
+META_FILE = 'meta.json'
+
+
+def shard_path(directory: str, kind: str, number: int) -> str:
+    return os.path.join(directory, f'{kind}-{number:05d}.npy')
+
+
+class ShardWriter:
+    """ Appends rows of one kind of embedding, saving each shard once it holds shard_size rows """
+
+    def __init__(self, directory: str, kind: str, shard_size: int, dtype: str = 'float32'):
+        self.directory = directory
+        self.kind = kind
+        self.buffer = np.empty((shard_size, KINDS[kind]), dtype=dtype)
+        self.shard = 0
+        self.rows = 0
+
+    def append(self, embeddings: np.ndarray) -> None:
+        start = 0
+        while start < len(embeddings):
+            count = min(len(embeddings) - start, len(self.buffer) - self.rows)
+            self.buffer[self.rows:self.rows + count] = embeddings[start:start + count]
+            self.rows += count
+            start += count
+            if self.rows == len(self.buffer):
+                self.flush()
+
+    def flush(self) -> None:
+        if self.rows == 0:
+            return
+        path = shard_path(self.directory, self.kind, self.shard)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, self.buffer[:self.rows])
+        os.replace(path + '.tmp', path)
+        self.shard += 1
+        self.rows = 0
+
+
+class EmbeddingShards:
+    """ Memory-mapped reader of a shard directory
+
+        shards = EmbeddingShards('embeddings/')
+        features = shards.get('geoclip', ['0.jpg', '1.jpg'])
+        for index, clip in shards.iter_shards('clip'):
+            ...
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.index = pd.read_csv(os.path.join(directory, INDEX_FILE))
+        self.shard_size = self.meta['shard_size']
+        self.num_shards = int(self.index['shard'].max()) + 1 if len(self.index) > 0 else 0
+        self._positions = {image: i for i, image in enumerate(self.index['IMG_FILE'])}
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, kind: str, number: int) -> np.ndarray:
+        """ The memory-mapped array of a shard """
+        if (kind, number) not in self._shards:
+            self._shards[kind, number] = np.load(shard_path(self.directory, kind, number), mmap_mode='r')
+        return self._shards[kind, number]
+
+    def positions(self, images: list) -> np.ndarray:
+        """ Rows of the index of the given IMG_FILE values, raises KeyError for images that were not exported """
+        return np.array([self._positions[image] for image in images], dtype=np.int64)
+
+    def get(self, kind: str, images: list = None, positions=None) -> np.ndarray:
+        """ Embeddings of the given images, or of the given rows of the index, copied into memory
+
+        Args:
+            kind (str): 'clip' or 'geoclip'
+            images (list): IMG_FILE values of the index
+            positions (np.ndarray | slice): Rows of the index, all of them when neither images nor positions are given
+        """
+        if images is not None:
+            positions = self.positions(images)
+        else:
+            positions = np.arange(len(self))[positions if positions is not None else slice(None)]
+        output = np.empty((len(positions), KINDS[kind]), dtype=self.meta['dtype'])
+        shards, rows = np.divmod(positions, self.shard_size)
+        for number in np.unique(shards):
+            selected = shards == number
+            output[selected] = self.shard(kind, int(number))[rows[selected]]
+        return output
+
+    def iter_shards(self, kind: str):
+        """ Yields the index rows and the memory-mapped embeddings of each shard, in order """
+        for number in range(self.num_shards):
+            start = number * self.shard_size
+            yield self.index.iloc[start:start + self.shard_size], self.shard(kind, number)
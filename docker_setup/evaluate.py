@@ -0,0 +1,247 @@
+""" Offline comparison of serving options against the float32 baseline on a validation manifest
+
+Manifests are csv files with IMG_FILE, LAT and LON columns, as written by create_dataset.py.
+
+    python evaluate.py gallery-precision val_dataset.csv --images-dir imagini/ --dtypes float16 int8
+    python evaluate.py image-encoder-precision val_dataset.csv --images-dir imagini/
+    python evaluate.py image-encoder-backend val_dataset.csv --images-dir imagini/
+    python evaluate.py preprocess-parity val_dataset.csv --images-dir imagini/
+"""
+import os
+import json
+import time
+import argparse
+import pandas as pd
+import torch
+from PIL import Image
+from model_loader import load_model
+from config import WEIGHTS_PATH
+
+EARTH_RADIUS_KM = 6371.0
+DISTANCES_KM = (1, 25, 200, 750, 2500)
+
+
+def haversine_km(gps_a: torch.Tensor, gps_b: torch.Tensor) -> torch.Tensor:
+    """ Great-circle distance in km between GPS coordinates of shape (..., 2) """
+    lat_a, lon_a = torch.deg2rad(gps_a[..., 0].double()), torch.deg2rad(gps_a[..., 1].double())
+    lat_b, lon_b = torch.deg2rad(gps_b[..., 0].double()), torch.deg2rad(gps_b[..., 1].double())
+    h = torch.sin((lat_b - lat_a) / 2) ** 2 + torch.cos(lat_a) * torch.cos(lat_b) * torch.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * torch.asin(torch.sqrt(h.clamp(0, 1)))
+
+
+def accuracy_at(pred_gps: torch.Tensor, true_gps: torch.Tensor, distances_km=DISTANCES_KM) -> dict:
+    """ Fraction of top-1 predictions within each distance of the ground truth """
+    errors = haversine_km(pred_gps, true_gps)
+    return {f'acc_{d}_km': float((errors <= d).double().mean()) for d in distances_km}
+
+
+def load_manifest(path: str, images_dir: str = None):
+    data = pd.read_csv(path)
+    paths = data['IMG_FILE'].tolist()
+    if images_dir is not None:
+        paths = [os.path.join(images_dir, p) for p in paths]
+    return paths, torch.tensor(data[['LAT', 'LON']].values, dtype=torch.float32)
+
+
+@torch.no_grad()
+def encode_manifest(model, paths: list, batch_size: int = 32) -> torch.Tensor:
+    return torch.cat([
+        model.encode_images(paths[start:start + batch_size]).cpu()
+        for start in range(0, len(paths), batch_size)
+    ])
+
+
+def time_per_image(fn, features: torch.Tensor, num_images: int = 200) -> float:
+    """ Mean milliseconds of fn over single-image batches, as served by /predict """
+    start = time.perf_counter()
+    for i in range(min(num_images, features.shape[0])):
+        fn(features[i:i + 1])
+    return (time.perf_counter() - start) * 1000 / min(num_images, features.shape[0])
+
+
+def topk_overlap(gps_a: torch.Tensor, gps_b: torch.Tensor) -> float:
+    """ Mean fraction of shared coordinates between two sets of top-k predictions of shape (n, k, 2) """
+    shared = [
+        len({tuple(p) for p in a.tolist()} & {tuple(p) for p in b.tolist()}) / a.shape[0]
+        for a, b in zip(gps_a, gps_b)
+    ]
+    return sum(shared) / len(shared)
+
+
+def cmd_gallery_precision(args) -> dict:
+    model = load_model(args.weights)
+    paths, true_gps = load_manifest(args.manifest, args.images_dir)
+    features = encode_manifest(model, paths, args.batch_size)
+
+    base_gps, base_prob = model.search_gallery(features, args.top_k)
+    results = {'float32': {
+        **accuracy_at(base_gps[:, 0], true_gps),
+        'ms_per_image': time_per_image(lambda f: model.search_gallery(f, args.top_k), features),
+        'store_mb': model.gallery_features.numel() * 4 / 2**20,
+    }}
+
+    for dtype in args.dtypes:
+        model.load_quantized_gallery(dtype=dtype, rerank=args.rerank)
+        store = model.gallery_index
+        gps, prob = model.search_gallery(features, args.top_k)
+        results[dtype] = {
+            **accuracy_at(gps[:, 0], true_gps),
+            'ms_per_image': time_per_image(lambda f: model.search_gallery(f, args.top_k), features),
+            'store_mb': (store.values.numel() * store.values.element_size()
+                         + (store.scales.numel() * 4 if store.scales is not None else 0)) / 2**20,
+            'top1_agreement': float((gps[:, 0] == base_gps[:, 0]).all(dim=1).double().mean()),
+            f'top{args.top_k}_overlap': topk_overlap(gps, base_gps),
+            'max_prob_diff': float((prob - base_prob).abs().max()),
+        }
+    model.gallery_index = None
+
+    return {'images': len(paths), 'top_k': args.top_k, 'rerank': args.rerank, 'results': results}
+
+
+@torch.no_grad()
+def encoder_ms_per_image(model, paths: list, batch_size: int, num_images: int = 64) -> float:
+    """ Mean milliseconds of the image encoder forward per image, preprocessing excluded """
+    pixels = model.preprocess_images([Image.open(p) for p in paths[:num_images]])
+    start = time.perf_counter()
+    for i in range(0, pixels.shape[0], batch_size):
+        model.image_encoder(pixels[i:i + batch_size])
+    return (time.perf_counter() - start) * 1000 / pixels.shape[0]
+
+
+def cmd_image_encoder_precision(args) -> dict:
+    model = load_model(args.weights)
+    paths, true_gps = load_manifest(args.manifest, args.images_dir)
+
+    results = {}
+    base_features, base_gps = None, None
+    for dtype in ('float32', 'int8'):
+        if dtype == 'int8':
+            model.quantize_image_encoder(args.weights)
+        features = encode_manifest(model, paths, args.batch_size)
+        gps, _ = model.search_gallery(features, args.top_k)
+        results[dtype] = {
+            **accuracy_at(gps[:, 0], true_gps),
+            'ms_per_image': encoder_ms_per_image(model, paths, 1),
+            f'ms_per_image_batch{args.batch_size}': encoder_ms_per_image(model, paths, args.batch_size),
+        }
+        if base_features is None:
+            base_features, base_gps = features, gps
+        else:
+            results[dtype].update({
+                'min_cosine': float((features * base_features).sum(dim=1).min()),
+                'top1_agreement': float((gps[:, 0] == base_gps[:, 0]).all(dim=1).double().mean()),
+                f'top{args.top_k}_overlap': topk_overlap(gps, base_gps),
+            })
+
+    return {'images': len(paths), 'threads': torch.get_num_threads(), 'results': results}
+
+
+def cmd_image_encoder_backend(args) -> dict:
+    paths, true_gps = load_manifest(args.manifest, args.images_dir)
+
+    results = {}
+    base_features, base_gps = None, None
+    for backend in ('eager', 'torchscript'):
+        start = time.perf_counter()
+        model = load_model(args.weights, image_encoder_backend=backend)
+        load_s = time.perf_counter() - start
+
+        features = encode_manifest(model, paths, args.batch_size)
+        gps, _ = model.search_gallery(features, args.top_k)
+        results[backend] = {
+            **accuracy_at(gps[:, 0], true_gps),
+            'load_s': load_s,
+            'ms_per_image': encoder_ms_per_image(model, paths, 1),
+            f'ms_per_image_batch{args.batch_size}': encoder_ms_per_image(model, paths, args.batch_size),
+        }
+        if base_features is None:
+            base_features, base_gps = features, gps
+        else:
+            results[backend].update({
+                'max_feature_diff': float((features - base_features).abs().max()),
+                'top1_agreement': float((gps[:, 0] == base_gps[:, 0]).all(dim=1).double().mean()),
+            })
+        del model
+
+    return {'images': len(paths), 'threads': torch.get_num_threads(), 'results': results}
+
+
+def cmd_preprocess_parity(args) -> dict:
+    model = load_model(args.weights)
+    paths, true_gps = load_manifest(args.manifest, args.images_dir)
+
+    results = {}
+    base_pixels, base_gps = None, None
+    for name, fast in (('image_processor', False), ('fast', True)):
+        model.set_fast_preprocessing(fast, draft_factor=args.draft_factor)
+        start = time.perf_counter()
+        pixels = torch.cat([
+            model.preprocess_images(paths[i:i + args.batch_size]) for i in range(0, len(paths), args.batch_size)
+        ])
+        ms_per_image = (time.perf_counter() - start) * 1000 / len(paths)
+
+        features = encode_manifest(model, list(pixels.split(1)), args.batch_size)
+        gps, _ = model.search_gallery(features, args.top_k)
+        results[name] = {**accuracy_at(gps[:, 0], true_gps), 'preprocess_ms_per_image': ms_per_image}
+        if base_pixels is None:
+            base_pixels, base_features, base_gps = pixels, features, gps
+        else:
+            results[name].update({
+                'max_pixel_diff': float((pixels - base_pixels).abs().max()),
+                'mean_pixel_diff': float((pixels - base_pixels).abs().mean()),
+                'min_cosine': float((features * base_features).sum(dim=1).min()),
+                'top1_agreement': float((gps[:, 0] == base_gps[:, 0]).all(dim=1).double().mean()),
+                f'top{args.top_k}_overlap': topk_overlap(gps, base_gps),
+            })
+
+    return {'images': len(paths), 'draft_factor': args.draft_factor, 'results': results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--output', default=None, help='json file for the report')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    gallery = subparsers.add_parser('gallery-precision', help='quantized gallery scoring against float32')
+    gallery.add_argument('manifest')
+    gallery.add_argument('--images-dir', default=None)
+    gallery.add_argument('--dtypes', nargs='+', default=['float16', 'int8'])
+    gallery.add_argument('--rerank', type=int, default=64)
+    gallery.add_argument('--top-k', type=int, default=5)
+    gallery.add_argument('--batch-size', type=int, default=32)
+    gallery.set_defaults(run=cmd_gallery_precision)
+
+    encoder = subparsers.add_parser('image-encoder-precision', help='int8 image encoder against float32')
+    encoder.add_argument('manifest')
+    encoder.add_argument('--images-dir', default=None)
+    encoder.add_argument('--top-k', type=int, default=5)
+    encoder.add_argument('--batch-size', type=int, default=32)
+    encoder.set_defaults(run=cmd_image_encoder_precision)
+
+    backend = subparsers.add_parser('image-encoder-backend', help='TorchScript image encoder against eager')
+    backend.add_argument('manifest')
+    backend.add_argument('--images-dir', default=None)
+    backend.add_argument('--top-k', type=int, default=5)
+    backend.add_argument('--batch-size', type=int, default=32)
+    backend.set_defaults(run=cmd_image_encoder_backend)
+
+    preprocess = subparsers.add_parser('preprocess-parity', help='fast preprocessing against the image processor')
+    preprocess.add_argument('manifest')
+    preprocess.add_argument('--images-dir', default=None)
+    preprocess.add_argument('--draft-factor', type=float, default=2.0)
+    preprocess.add_argument('--top-k', type=int, default=5)
+    preprocess.add_argument('--batch-size', type=int, default=32)
+    preprocess.set_defaults(run=cmd_preprocess_parity)
+
+    args = parser.parse_args()
+    report = args.run(args)
+
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
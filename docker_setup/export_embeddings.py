@@ -0,0 +1,92 @@
+""" Export the CLIP and GeoCLIP image embeddings of a csv manifest or a directory of images to .npy shards
+
+The image encoder runs once per image and the embeddings are written in the layout read by
+embedding_shards.EmbeddingShards, so evaluating a gallery, retrieval or error analysis can work from the
+shards instead of running ViT-L/14 on the images again. Images that cannot be decoded are left out of
+the index and listed at the end.
+
+    python export_embeddings.py val_dataset.csv --images-dir imagini/ --output embeddings/
+    python export_embeddings.py imagini/ --output embeddings/ --shard-size 65536 --dtype float16
+"""
+import os
+import json
+import time
+import argparse
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from batch_inference import ImageDataset, list_images
+from embedding_shards import KINDS, INDEX_FILE, META_FILE, ShardWriter
+from model_loader import load_model
+from config import WEIGHTS_PATH, FAST_PREPROCESS
+
+
+@torch.no_grad()
+def export(model, data: pd.DataFrame, output: str, shard_size: int, dtype: str, batch_size: int, workers: int) -> list:
+    """ Write the shards and index of data to output, returns the IMG_FILE of the images that cannot be decoded """
+    image_encoder = model.image_encoder
+    writers = {kind: ShardWriter(output, kind, shard_size, dtype) for kind in KINDS}
+    loader = DataLoader(
+        ImageDataset(data['PATH'].tolist(), model), batch_size=batch_size, num_workers=workers,
+        pin_memory=str(model.device).startswith('cuda'),
+    )
+
+    exported, failed = [], []
+    for indices, pixels, decoded in loader:
+        failed += data['IMG_FILE'].iloc[indices[~decoded].numpy()].tolist()
+        if not decoded.any():
+            continue
+        clip = image_encoder.CLIP.get_image_features(pixel_values=pixels[decoded].to(model.device))
+        geoclip = image_encoder.mlp(clip)
+        writers['clip'].append(clip.cpu().numpy())
+        writers['geoclip'].append(geoclip.cpu().numpy())
+        exported += indices[decoded].tolist()
+        print(f'{len(exported)} / {len(data)} images', end='\r')
+    for writer in writers.values():
+        writer.flush()
+
+    index = data.iloc[exported].drop(columns='PATH').reset_index(drop=True)
+    index['shard'], index['row'] = index.index // shard_size, index.index % shard_size
+    index.to_csv(os.path.join(output, INDEX_FILE), index=False)
+    return failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='csv manifest with IMG_FILE (and LAT, LON) columns, or a directory of images')
+    parser.add_argument('--images-dir', default=None, help='directory the IMG_FILE paths of the manifest are relative to')
+    parser.add_argument('--output', required=True, help='directory of the shards')
+    parser.add_argument('--shard-size', type=int, default=65536, help='rows per shard')
+    parser.add_argument('--dtype', choices=('float32', 'float16'), default='float32')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1), help='decoding and preprocessing processes')
+    parser.add_argument('--fast-preprocess', action=argparse.BooleanOptionalAction, default=FAST_PREPROCESS)
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    args = parser.parse_args()
+
+    data = list_images(args.source, args.images_dir)
+    os.makedirs(args.output, exist_ok=True)
+
+    # the TorchScript image encoder is a single graph, without the CLIP features before the mlp head
+    model = load_model(args.weights, image_encoder_backend='eager', fast_preprocess=args.fast_preprocess)
+    failed = export(model, data, args.output, args.shard_size, args.dtype, args.batch_size, args.workers)
+
+    with open(os.path.join(args.output, META_FILE), 'w') as f:
+        json.dump({
+            'source': os.path.abspath(args.source),
+            'images': len(data) - len(failed),
+            'shard_size': args.shard_size,
+            'dtype': args.dtype,
+            'dims': KINDS,
+            'fast_preprocess': args.fast_preprocess,
+            'weights': os.path.abspath(args.weights),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=2)
+
+    print(f'\n{len(data) - len(failed)} images exported to {args.output}')
+    for image in failed:
+        print(f'Cannot decode the image: {image}')
+
+
+if __name__ == '__main__':
+    main()
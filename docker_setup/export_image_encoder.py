@@ -0,0 +1,48 @@
+""" Export the image encoder (CLIP vision tower, visual projection and MLP head) to a frozen TorchScript graph,
+loaded by the server when IMAGE_ENCODER_BACKEND=torchscript
+
+The exported graph is checked against the eager encoder on random inputs before the command returns.
+
+    python export_image_encoder.py --iteration-id 24_bestacc_1km
+"""
+import sys
+import argparse
+import torch
+import torch.nn.functional as F
+from _geoclip.model.image_encoder import TracedImageEncoder, torchscript_path
+from model_loader import load_model, DEVICE
+from config import WEIGHTS_PATH
+
+
+@torch.no_grad()
+def max_feature_diff(eager, traced, num_images: int = 8, batch_size: int = 4) -> float:
+    """ Largest absolute difference of the normalized features of both encoders on random images """
+    generator = torch.Generator().manual_seed(0)
+    pixels = torch.randn(num_images, 3, 224, 224, generator=generator).to(DEVICE)
+    diffs = [
+        (F.normalize(eager(batch), dim=1) - F.normalize(traced(batch), dim=1)).abs().max()
+        for batch in pixels.split(batch_size)
+    ]
+    return float(max(diffs))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--iteration-id', default='24_bestacc_1km')
+    parser.add_argument('--output', default=None, help='defaults to the path loaded by load_model')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    output = args.output or torchscript_path(args.weights, args.iteration_id)
+    model = load_model(args.weights, iteration_id=args.iteration_id)
+    model.image_encoder.export_torchscript(output)
+
+    diff = max_feature_diff(model.image_encoder, TracedImageEncoder(output, device=DEVICE))
+    print(f"saved {output}, max feature difference {diff:.2e}")
+    if diff > args.atol:
+        sys.exit(f"exported graph differs from the eager encoder by more than {args.atol}")
+
+
+if __name__ == '__main__':
+    main()
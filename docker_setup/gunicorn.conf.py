@@ -0,0 +1,59 @@
+""" Pre-fork serving of main.py with gunicorn
+
+The model and the gallery features are loaded once in the master process (preload_app) and the workers
+are forked from it, sharing those pages copy-on-write instead of each loading their own copy.
+Set SHARE_MODEL_MEMORY=1 to move them to shared memory where copy-on-write sharing is not reliable.
+The tensors are then held in /dev/shm, which Docker limits to 64 MB: start the container with
+--shm-size=2g (shm_size: 2gb in compose) or more for larger galleries.
+
+    gunicorn -c gunicorn.conf.py
+
+CUDA does not survive fork, so on GPU nodes the workers load their own model after forking.
+"""
+import gc
+import os
+import sys
+import atexit
+import torch
+
+preload_app = not torch.cuda.is_available()
+if preload_app:
+    # the workers fork from the master once main.py is imported, which has to include the loaded model;
+    # set before config is imported, which reads LOAD_IN_BACKGROUND once
+    os.environ['LOAD_IN_BACKGROUND'] = '0'
+
+from config import SERVING_PROFILE
+
+wsgi_app = 'main:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', SERVING_PROFILE.get('web_workers', os.cpu_count() or 1)))
+# requests handled concurrently by each worker, which the micro-batcher groups into batches
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+
+# the serving profile written by autotune.py, otherwise each worker gets its share of the cores for intra-op parallelism
+torch_threads = int(os.environ.get(
+    'TORCH_THREADS_PER_WORKER', SERVING_PROFILE.get('torch_threads', max(1, (os.cpu_count() or 1) // workers))
+))
+
+
+def when_ready(server):
+    # main.py registers the embedding cache save at exit in the process that loads it, which under preload_app
+    # is the master: it exits last with only the entries loaded at startup, so the workers save instead
+    cache = getattr(sys.modules.get('main'), 'CACHE', None)
+    if cache is not None:
+        atexit.unregister(cache.save)
+
+
+def pre_fork(server, worker):
+    # move the objects created while loading the model out of the garbage collector's reach,
+    # so collections in the workers do not write to (and copy) the pages holding them
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    torch.set_num_threads(torch_threads)
+    cache = getattr(sys.modules.get('main'), 'CACHE', None)
+    if cache is not None:
+        atexit.register(cache.save)
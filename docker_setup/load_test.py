@@ -0,0 +1,340 @@
+""" Load generator for the inference server
+
+Replays a directory of images, or a request log, against a running server (or one started with --server-cmd)
+and writes latency percentiles, throughput, errors and the server memory over time as JSON.
+
+The memory of a server started with --server-cmd is summed over its processes, as RSS and as PSS. Pages
+that pre-forked workers share copy-on-write count once per process in the RSS sum, and are split between
+those processes in the PSS sum, so PSS is the memory the server really uses.
+
+A request log is a JSONL file with one request per line:
+
+    {"image": "imagini/1.jpg", "endpoint": "/predict", "region": "europe", "offset_s": 0.25}
+
+Only "image" is required. With --rate 0 every client sends its next request as soon as the previous one
+completes (closed loop), otherwise requests arrive at --rate per second as a Poisson process whatever
+the server latency (open loop) and their latency includes the time spent waiting for a free client.
+--replay-timing sends the requests of a log at their recorded offset_s instead.
+
+    python load_test.py --images imagini/ --concurrency 8 --duration 60
+    python load_test.py --log requests.jsonl --rate 20 --concurrency 32 --label gunicorn-4x4 \\
+        --server-cmd "gunicorn -c gunicorn.conf.py"
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import shlex
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+RSS_METRIC = 'geoclip_process_resident_memory_bytes'
+
+
+def load_requests(images_dir: str = None, log_path: str = None) -> list:
+    if log_path is not None:
+        base_dir = os.path.dirname(os.path.abspath(log_path))
+        requests = []
+        with open(log_path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry['image'] = os.path.join(base_dir, entry['image'])
+                    requests.append(entry)
+        return requests
+
+    return [
+        {'image': os.path.join(images_dir, name)}
+        for name in sorted(os.listdir(images_dir)) if name.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+def encode_multipart(fields: dict, files: list) -> tuple:
+    """ multipart/form-data body of form fields and (field name, file name, bytes) files """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def send(url: str, entry: dict, timeout: float) -> int:
+    """ Send one logged request, returns the HTTP status code """
+    endpoint = entry.get('endpoint', '/predict')
+    field = 'images' if endpoint == '/predict_batch' else 'image'
+    with open(entry['image'], 'rb') as f:
+        data = f.read()
+    fields = {'region': entry['region']} if entry.get('region') else {}
+    body, content_type = encode_multipart(fields, [(field, os.path.basename(entry['image']), data)])
+
+    request = urllib.request.Request(url + endpoint, data=body, headers={'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def process_tree_memory_bytes(pid: int) -> tuple[int, int | None]:
+    """ RSS and PSS summed over a process and its descendants, e.g. a gunicorn master and its workers.
+    PSS is None on kernels without /proc/<pid>/smaps_rollup.
+    """
+    rss, pss = 0, 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            if pss is not None:
+                pss = pss + process_pss_bytes(pid) if os.path.exists(f'/proc/{pid}/smaps_rollup') else None
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return rss, pss
+
+
+def process_pss_bytes(pid: int) -> int:
+    """ Proportional set size of a process: its private pages plus its share of the pages it shares """
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def scrape_rss_bytes(url: str) -> int | None:
+    """ RSS reported on /metrics by the server process that answered the scrape """
+    try:
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith(RSS_METRIC):
+                    return int(float(line.split()[-1]))
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def start_server(command: str, url: str, timeout: float) -> subprocess.Popen:
+    """ Start the server and wait until it answers /metrics """
+    server = subprocess.Popen(shlex.split(command))
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode} before it was ready')
+        if scrape_rss_bytes(url) is not None:
+            return server
+        time.sleep(0.5)
+    server.terminate()
+    raise TimeoutError(f'Server was not ready after {timeout:.0f} s')
+
+
+def schedule(requests: list, rate: float, duration: float, replay_timing: bool, seed: int):
+    """ Yields (offset in seconds, request) of the open loop arrivals """
+    rng = random.Random(seed)
+    if replay_timing:
+        first = min(entry.get('offset_s', 0.0) for entry in requests)
+        for entry in sorted(requests, key=lambda entry: entry.get('offset_s', 0.0)):
+            offset = entry.get('offset_s', 0.0) - first
+            if offset >= duration:
+                return
+            yield offset, entry
+        return
+
+    offset, index = 0.0, 0
+    while True:
+        offset += rng.expovariate(rate)
+        if offset >= duration:
+            return
+        yield offset, requests[index % len(requests)]
+        index += 1
+
+
+def run(url: str, requests: list, concurrency: int, rate: float, duration: float, replay_timing: bool,
+        timeout: float, memory_fn, scrape_interval: float, seed: int) -> dict:
+    results = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def record(entry: dict, scheduled: float) -> None:
+        try:
+            status = str(send(url, entry, timeout))
+        except Exception as e:
+            status = type(e).__name__
+        end = time.perf_counter()
+        with lock:
+            results.append((scheduled - start, end - scheduled, status))
+
+    open_loop = rate > 0 or replay_timing
+    arrivals = queue.Queue()
+
+    def client(index: int) -> None:
+        if open_loop:
+            while (item := arrivals.get()) is not None:
+                record(item[1], item[0])
+            return
+        position = index
+        while time.perf_counter() - start < duration:
+            record(requests[position % len(requests)], time.perf_counter())
+            position += concurrency
+
+    rss_samples, pss_samples = [], []
+    stop_sampling = threading.Event()
+
+    def sample_memory() -> None:
+        while not stop_sampling.is_set():
+            rss, pss = memory_fn()
+            now = round(time.perf_counter() - start, 3)
+            if rss is not None:
+                rss_samples.append((now, rss))
+            if pss is not None:
+                pss_samples.append((now, pss))
+            stop_sampling.wait(scrape_interval)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in clients: t.start()
+
+    if open_loop:
+        for offset, entry in schedule(requests, rate, duration, replay_timing, seed):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            arrivals.put((start + offset, entry))
+        for _ in clients:
+            arrivals.put(None)
+
+    for t in clients: t.join()
+    elapsed = time.perf_counter() - start
+    stop_sampling.set()
+    sampler.join()
+
+    return summarize(results, elapsed, rss_samples, pss_samples)
+
+
+def summarize(results: list, elapsed: float, rss_samples: list, pss_samples: list = ()) -> dict:
+    latencies_ms = np.array([latency for _, latency, status in results if status == '200']) * 1000
+    statuses = {}
+    for _, _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def percentiles(values) -> dict:
+        if len(values) == 0:
+            return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+        return {f'p{q}_ms': float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+    # one row per second of the run, by the time the request was sent
+    seconds = [[] for _ in range(int(np.ceil(elapsed)))]
+    for sent, latency, status in results:
+        seconds[min(int(sent), len(seconds) - 1)].append((latency, status))
+
+    timeline = []
+    for second, window in enumerate(seconds):
+        ok = np.array([latency for latency, status in window if status == '200']) * 1000
+        timeline.append({
+            'second': second,
+            'requests': len(window),
+            'errors': sum(status != '200' for _, status in window),
+            **percentiles(ok)
+        })
+
+    return {
+        'requests': len(results),
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies_ms) / elapsed,
+        'error_rate': 1 - len(latencies_ms) / len(results) if results else 0.0,
+        'statuses': statuses,
+        **percentiles(latencies_ms),
+        'max_rss_bytes': max((rss for _, rss in rss_samples), default=None),
+        'rss_bytes': rss_samples,
+        'max_pss_bytes': max((pss for _, pss in pss_samples), default=None),
+        'pss_bytes': list(pss_samples),
+        'timeline': timeline,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help='directory of images, each sent to /predict in turn')
+    source.add_argument('--log', help='JSONL request log')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of clients')
+    parser.add_argument('--rate', type=float, default=0.0, help='open loop arrivals per second, 0 for closed loop')
+    parser.add_argument('--replay-timing', action='store_true', help='send logged requests at their offset_s')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds during which requests are sent')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds before a request counts as failed')
+    parser.add_argument('--server-cmd', default=None, help='start the server with this command and stop it afterwards')
+    parser.add_argument('--startup-timeout', type=float, default=300.0)
+    parser.add_argument('--scrape-interval', type=float, default=1.0, help='seconds between memory samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None, help='name of the serving configuration, stored in the output')
+    parser.add_argument('--output', default='load_test.json')
+    args = parser.parse_args()
+
+    requests = load_requests(args.images, args.log)
+    if len(requests) == 0:
+        parser.error('no requests to send')
+    url = args.url.rstrip('/')
+
+    server = None
+    if args.server_cmd is not None:
+        server = start_server(args.server_cmd, url, args.startup_timeout)
+        memory_fn = lambda: process_tree_memory_bytes(server.pid)
+    else:
+        memory_fn = lambda: (scrape_rss_bytes(url), None)
+
+    try:
+        summary = run(
+            url, requests, args.concurrency, args.rate, args.duration, args.replay_timing,
+            args.timeout, memory_fn, args.scrape_interval, args.seed
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"{summary['requests']} requests, {summary['throughput_rps']:.2f} req/s, "
+          f"error rate {summary['error_rate']:.2%}, p50 {summary['p50_ms'] or 0:.1f} ms, "
+          f"p95 {summary['p95_ms'] or 0:.1f} ms, p99 {summary['p99_ms'] or 0:.1f} ms")
+    if summary['max_rss_bytes'] is not None:
+        pss = f", PSS {summary['max_pss_bytes'] / 2**20:.0f} MB" if summary['max_pss_bytes'] is not None else ''
+        print(f"peak memory: RSS {summary['max_rss_bytes'] / 2**20:.0f} MB{pss}")
+
+    config = {
+        'label': args.label, 'commit': git_commit(), 'url': url, 'source': args.images or args.log,
+        'concurrency': args.concurrency, 'rate': args.rate, 'replay_timing': args.replay_timing,
+        'duration_s': args.duration, 'server_cmd': args.server_cmd,
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'config': config, **summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
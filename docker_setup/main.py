@@ -1,21 +1,179 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from model_loader import load_model, predict_image
+import atexit
+import threading
+from timing import StartupTimer
+
+TIMER = StartupTimer()
+with TIMER.phase('imports'):
+    from flask import Flask, Response, g, request, jsonify, stream_with_context
+    from flask_cors import CORS
+    from model_loader import (
+        load_served_model, configure_torch_threads, warmup_model, share_model_memory, create_batcher,
+        create_embedding_cache, predict_image, predict_images, predict_stream
+    )
+    from archive import archive_kind, iter_archive, ndjson_predictions, spool, NDJSON_CONTENT_TYPE
+    import metrics
+    from admission import AdmissionController, Overloaded, DeadlineExceeded, TIMEOUT_HEADER
+    from config import (
+        MAX_BATCH_SIZE, MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW_MS, REQUEST_REGIONS,
+        IMAGE_ENCODER_DTYPE, IMAGE_ENCODER_BACKEND, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_MB, EMBEDDING_CACHE_PATH,
+        FAST_PREPROCESS, SHARE_MODEL_MEMORY,
+        WARMUP_BATCH_SIZES, WARMUP_ROUNDS, LOAD_IN_BACKGROUND, MAX_PENDING_REQUESTS, RETRY_AFTER_S,
+        LOADING_RETRY_AFTER_S, REQUEST_TIMEOUT_S, TORCH_THREADS, TORCH_INTEROP_THREADS, ARCHIVE_BATCH_SIZE,
+        ARCHIVE_MAX_MEMBER_MB
+    )
 
 app = Flask(__name__)
 CORS(app)
-WEIGHTS_PATH = "_geoclip/model/weights"
-MODEL = load_model(WEIGHTS_PATH)
+MODEL = None
+BATCHER = None
+CACHE = None
+READY = threading.Event()
+LOAD_ERROR = None
+INFERENCE_ENDPOINTS = {'predict', 'predict_batch', 'predict_archive', 'cache_stats'}
+metrics.Gauge('geoclip_ready', 'Whether the model is loaded and warmed up', fn=lambda: int(READY.is_set()))
+ADMISSION = AdmissionController(MAX_PENDING_REQUESTS, REQUEST_TIMEOUT_S)
+metrics.register_admission_metrics(ADMISSION)
+
+def load():
+    global MODEL, BATCHER, CACHE, LOAD_ERROR
+    try:
+        configure_torch_threads(TORCH_THREADS, TORCH_INTEROP_THREADS)
+        MODEL = load_served_model(timer=TIMER)
+        BATCHER = create_batcher(MODEL, MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW_MS)
+        if BATCHER is not None:
+            metrics.register_batcher_metrics(BATCHER)
+        CACHE = create_embedding_cache(
+            EMBEDDING_CACHE_SIZE,
+            max_mb=EMBEDDING_CACHE_MB,
+            persist_path=EMBEDDING_CACHE_PATH,
+            namespace=f"{MODEL.iteration_id}-{IMAGE_ENCODER_BACKEND}-{IMAGE_ENCODER_DTYPE}-{'fast' if FAST_PREPROCESS else 'hf'}"
+        )
+        if CACHE is not None:
+            atexit.register(CACHE.save)
+            metrics.register_cache_metrics(CACHE)
+        with TIMER.phase('warmup'):
+            warmup_model(MODEL, WARMUP_BATCH_SIZES, WARMUP_ROUNDS, regions=REQUEST_REGIONS)
+        if SHARE_MODEL_MEMORY:
+            with TIMER.phase('shared memory'):
+                share_model_memory(MODEL)
+    except Exception as e:
+        LOAD_ERROR = e
+        raise
+    print(TIMER.report(), flush=True)
+    READY.set()
+
+if LOAD_IN_BACKGROUND:
+    threading.Thread(target=load, name='model-loader', daemon=True).start()
+else:
+    load()
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = metrics.start_request(request.endpoint or 'unknown')
+
+@app.after_request
+def finish_request_metrics(response):
+    metrics.finish_request(request.endpoint or 'unknown', response.status_code, g.metrics_start)
+    return response
+
+@app.before_request
+def require_ready():
+    if request.endpoint in INFERENCE_ENDPOINTS and not READY.is_set():
+        return jsonify({'error': 'The model is loading'}), 503, {'Retry-After': str(LOADING_RETRY_AFTER_S)}
+
+@app.before_request
+def admit_request():
+    # before the upload is parsed, so rejected requests cost no memory
+    if request.endpoint in ('predict', 'predict_batch', 'predict_archive'):
+        g.ticket = ADMISSION.admit(request.headers.get(TIMEOUT_HEADER))
+
+@app.teardown_request
+def release_request(exc):
+    if g.pop('ticket', None) is not None:
+        ADMISSION.release()
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify({'error': 'The server is overloaded'}), 503, {'Retry-After': str(RETRY_AFTER_S)}
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({'error': 'The request timed out before it was processed'}), 504
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    if LOAD_ERROR is not None:
+        return jsonify({'status': 'failed', 'error': repr(LOAD_ERROR)}), 500
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if not READY.is_set():
+        return jsonify({'status': 'loading'}), 503
+    return jsonify({'status': 'ready'})
 
 @app.route('/predict', methods=['POST'])
 def predict():
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
 
+    region = request.values.get('region')
+    if region is not None and region not in MODEL.region_galleries:
+        return jsonify({'error': f'Unknown region: {region}'}), 400
+
     img = request.files['image']
-    predictions = predict_image(MODEL, img)
+    predictions = predict_image(MODEL, img, batcher=BATCHER, region=region, cache=CACHE, ticket=g.ticket)
+    return jsonify({'predictions': predictions})
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    images = request.files.getlist('images')
+    if len(images) == 0:
+        return jsonify({'error': 'No images provided'}), 400
+    if len(images) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'Too many images, the maximum batch size is {MAX_BATCH_SIZE}'}), 413
+
+    region = request.values.get('region')
+    if region is not None and region not in MODEL.region_galleries:
+        return jsonify({'error': f'Unknown region: {region}'}), 400
+
+    predictions = predict_images(MODEL, images, region=region, cache=CACHE, ticket=g.ticket)
     return jsonify({'predictions': predictions})
 
+@app.route('/predict_archive', methods=['POST'])
+def predict_archive():
+    """ Predictions of the images of a zip or tar archive, sent as the request body or as an "archive"
+    multipart file, streamed back as one NDJSON line per image as each batch is predicted.
+    A tar body is read while the response is written, so clients have to read the response as they upload.
+    """
+    if 'archive' in request.files:
+        upload = request.files['archive']
+        kind = archive_kind(upload.mimetype, upload.filename)
+        # Flask closes the uploaded files when the view returns, before the response is streamed
+        fileobj = spool(upload.stream) if kind is not None else None
+    else:
+        fileobj, kind = request.stream, archive_kind(request.mimetype)
+    if kind is None:
+        return jsonify({'error': 'Expected a zip or tar archive'}), 415
+
+    region = request.values.get('region')
+    if region is not None and region not in MODEL.region_galleries:
+        return jsonify({'error': f'Unknown region: {region}'}), 400
+
+    members = iter_archive(fileobj, kind, int(ARCHIVE_MAX_MEMBER_MB * 2**20))
+    results = predict_stream(MODEL, members, batch_size=ARCHIVE_BATCH_SIZE, region=region, cache=CACHE)
+    return Response(stream_with_context(ndjson_predictions(results)), content_type=NDJSON_CONTENT_TYPE)
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    if CACHE is None:
+        return jsonify({'error': 'The embedding cache is disabled'}), 404
+    return jsonify(CACHE.stats())
+
+@app.route('/metrics', methods=['GET'], endpoint='metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
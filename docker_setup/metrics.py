@@ -0,0 +1,186 @@
+""" Prometheus text format metrics of the inference server
+
+Metrics are plain in-process aggregates (a counter, a gauge, or bucket counts) updated under a lock,
+so recording costs a few microseconds and nothing is kept per request. The text is only built
+when /metrics is scraped. With several worker processes each one keeps and serves its own metrics.
+"""
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = (), fn=None):
+        """
+        Args:
+            name (str): Metric name
+            help (str): Description shown by Prometheus
+            labels (tuple): Label names, values are passed positionally when recording
+            fn (callable): Read the value at scrape time instead of recording it, returns a number
+                or a dict from label value tuples to numbers
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _samples(self) -> dict:
+        if self.fn is None:
+            with self._lock:
+                return dict(self._values)
+        value = self.fn()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for label_values, value in sorted(self._samples().items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = STAGE_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum of the observed values
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for label_values, counts in sorted(self._samples().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+    def _samples(self) -> dict:
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+
+def process_rss_bytes() -> int:
+    """ Resident set size of this process, the peak one where /proc is not available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUESTS = Counter('geoclip_requests_total', 'Requests by endpoint and status code', ('endpoint', 'status'))
+REQUEST_SECONDS = Histogram('geoclip_request_seconds', 'Request latency by endpoint', ('endpoint',))
+IN_FLIGHT = Gauge('geoclip_requests_in_flight', 'Requests being handled by endpoint', ('endpoint',))
+STAGE_SECONDS = Histogram(
+    'geoclip_stage_seconds',
+    'Latency of the inference stages: read, preprocess, image_encoder, gallery_search, serialize',
+    ('stage',)
+)
+BATCH_SIZE = Histogram('geoclip_batch_size', 'Images per image encoder forward', buckets=BATCH_SIZE_BUCKETS)
+SHED = Counter(
+    'geoclip_requests_shed_total',
+    'Inference requests rejected or dropped: queue_full, deadline or disconnected',
+    ('reason',)
+)
+RSS_BYTES = Gauge('geoclip_process_resident_memory_bytes', 'Resident set size of the process', fn=process_rss_bytes)
+
+
+def start_request(endpoint: str) -> float:
+    IN_FLIGHT.inc(endpoint)
+    return time.perf_counter()
+
+
+def finish_request(endpoint: str, status_code: int, start: float) -> None:
+    """ Record a request started with start_request """
+    IN_FLIGHT.dec(endpoint)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+    REQUESTS.inc(endpoint, str(status_code))
+
+
+def register_admission_metrics(admission) -> None:
+    """ Export the number of admitted requests of an AdmissionController and its bound """
+    Gauge('geoclip_admission_pending', 'Inference requests admitted and not finished', fn=lambda: admission.pending)
+    Gauge('geoclip_admission_max_pending', 'Bound on admitted inference requests, 0 for none', fn=lambda: admission.max_pending)
+
+
+def register_batcher_metrics(batcher) -> None:
+    Gauge('geoclip_batcher_queue_depth', 'Items waiting for the micro-batcher', fn=batcher.qsize)
+
+
+def register_cache_metrics(cache) -> None:
+    """ Export the counters of an EmbeddingCache, read at scrape time """
+    Counter('geoclip_embedding_cache_hits_total', 'Embedding cache hits', fn=lambda: cache.stats()['hits'])
+    Counter('geoclip_embedding_cache_misses_total', 'Embedding cache misses', fn=lambda: cache.stats()['misses'])
+    Counter('geoclip_embedding_cache_evictions_total', 'Embedding cache evictions', fn=lambda: cache.stats()['evictions'])
+    Gauge('geoclip_embedding_cache_entries', 'Embedding cache entries', fn=lambda: cache.stats()['entries'])
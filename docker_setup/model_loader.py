@@ -1,38 +1,355 @@
 from _geoclip import GeoCLIP
-import tempfile
+from _geoclip.model.image_encoder import ImageEncoder, TracedImageEncoder, torchscript_path, CLIP_MODEL
+from _geoclip.model.misc import restrict_gallery
+from batching import MicroBatcher
+from embedding_cache import EmbeddingCache
+from admission import DeadlineExceeded, ClientDisconnected
+from timing import StartupTimer
+from metrics import STAGE_SECONDS, BATCH_SIZE
+from config import (
+    WEIGHTS_PATH, ANN_NLIST, ANN_NPROBE, REFINE_ROUNDS, REFINE_CANDIDATES, REFINE_GRID_SIZE, REFINE_SPACING_KM,
+    GALLERY_REGION, GALLERY_REGION_NAMES, GALLERY_GRID_KM, REQUEST_REGIONS, GALLERY_DTYPE, GALLERY_RERANK,
+    IMAGE_ENCODER_DTYPE, IMAGE_ENCODER_BACKEND, SCORING_CHUNK_SIZE, CLIP_MODEL_PATH, FAST_PREPROCESS
+)
+import io
+import os
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import numpy as np
 from PIL import Image
 import torch
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def load_model(model_path: str) -> GeoCLIP:
-    model = GeoCLIP(from_pretrained=False)
-    model.load_finetuned_weights(
-        weight_dir=model_path,
-        iteration_id='24_bestacc_1km'
-    )
-    model.to(DEVICE)
-    model.eval()
+def load_model(model_path: str, iteration_id: str = '24_bestacc_1km', ann_nlist: int = 0, ann_nprobe: int = 32,
+               region: str = None, region_names: list = None, region_grid_km: float = None,
+               request_regions: list = (), gallery_dtype: str = 'float32', gallery_rerank: int = 64,
+               image_encoder_dtype: str = 'float32', image_encoder_backend: str = 'eager',
+               scoring_chunk_size: int = 16384, clip_model: str = CLIP_MODEL, fast_preprocess: bool = False,
+               timer: StartupTimer = None) -> GeoCLIP:
+    timer = timer if timer is not None else StartupTimer()
+
+    with timer.phase('image encoder'):
+        if image_encoder_backend == 'torchscript':
+            if image_encoder_dtype != 'float32':
+                raise ValueError("The TorchScript image encoder cannot be quantized")
+            image_encoder = TracedImageEncoder(torchscript_path(model_path, iteration_id), device=DEVICE)
+        elif image_encoder_backend == 'eager':
+            image_encoder = ImageEncoder(clip_model)
+        else:
+            raise ValueError(f"Unsupported image encoder backend: {image_encoder_backend}")
+
+    with timer.phase('weights'):
+        model = GeoCLIP(from_pretrained=False, image_encoder=image_encoder)
+        model.load_finetuned_weights(
+            weight_dir=model_path,
+            iteration_id=iteration_id
+        )
+        model.to(DEVICE)
+        model.eval()
+        model.scoring_chunk_size = scoring_chunk_size
+        model.set_fast_preprocessing(fast_preprocess)
+        if image_encoder_dtype == 'int8':
+            model.quantize_image_encoder(model_path)
+        elif image_encoder_dtype != 'float32':
+            raise ValueError(f"Unsupported image encoder dtype: {image_encoder_dtype}")
+
+    with timer.phase('gallery'):
+        cache_dir = os.path.join(model_path, 'gallery_cache')
+        full_gallery = model.gps_gallery_path
+        if region is not None:
+            model.set_gallery(restrict_gallery(full_gallery, region, cache_dir, region_names, region_grid_km))
+        model.load_gallery_features(cache_dir=cache_dir)
+        if ann_nlist > 0 and gallery_dtype != 'float32':
+            raise ValueError("The ANN index and the quantized gallery cannot be used together")
+        if ann_nlist > 0:
+            model.load_ann_index(nlist=ann_nlist, nprobe=ann_nprobe)
+        if gallery_dtype != 'float32':
+            model.load_quantized_gallery(dtype=gallery_dtype, rerank=gallery_rerank)
+
+        for name in request_regions:
+            model.add_region_gallery(name, restrict_gallery(full_gallery, name, cache_dir, grid_spacing_km=region_grid_km), cache_dir)
+
+    return model
+
+def served_model_settings() -> dict:
+    """ Arguments of load_model and set_refinement the servers take from config.py """
+    return {
+        'load_model': {
+            'ann_nlist': ANN_NLIST,
+            'ann_nprobe': ANN_NPROBE,
+            'region': GALLERY_REGION,
+            'region_names': GALLERY_REGION_NAMES,
+            'region_grid_km': GALLERY_GRID_KM,
+            'request_regions': REQUEST_REGIONS,
+            'gallery_dtype': GALLERY_DTYPE,
+            'gallery_rerank': GALLERY_RERANK,
+            'image_encoder_dtype': IMAGE_ENCODER_DTYPE,
+            'image_encoder_backend': IMAGE_ENCODER_BACKEND,
+            'scoring_chunk_size': SCORING_CHUNK_SIZE,
+            'clip_model': CLIP_MODEL_PATH,
+            'fast_preprocess': FAST_PREPROCESS,
+        },
+        'refinement': {
+            'refine_rounds': REFINE_ROUNDS,
+            'num_candidates': REFINE_CANDIDATES,
+            'grid_size': REFINE_GRID_SIZE,
+            'grid_spacing_km': REFINE_SPACING_KM,
+        },
+    }
 
+def load_served_model(model_path: str = WEIGHTS_PATH, timer: StartupTimer = None) -> GeoCLIP:
+    """ The model main.py and asgi_main.py serve, loaded and configured from config.py """
+    settings = served_model_settings()
+    model = load_model(model_path, timer=timer, **settings['load_model'])
+    model.set_refinement(**settings['refinement'])
     return model
 
-def predict_image(model, file_storage, k=5):
-    image = Image.open(file_storage).convert("RGB")
-
-    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as temp_file:
-        image.save(temp_file.name)
-        predictions = model.predict(image_path=temp_file.name, top_k=k)
-
-    def convert_to_serializable(obj):
-        if isinstance(obj, tuple):
-            return [convert_to_serializable(item) for item in obj]
-        elif isinstance(obj, list):
-            return [convert_to_serializable(item) for item in obj]
-        elif hasattr(obj, 'tolist'):
-            return obj.tolist()
-        elif hasattr(obj, 'numpy'):
-            return obj.numpy().tolist()
+def configure_torch_threads(intra_op: int = 0, inter_op: int = 0) -> None:
+    """ Size the torch thread pools, 0 keeps the default (one intra-op thread per core, which
+    oversubscribes the cores when several workers share them)
+    """
+    if inter_op > 0:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            # the inter-op pool can only be sized before it starts
+            pass
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+
+def synthetic_jpeg(width: int = 640, height: int = 480) -> bytes:
+    """ Random noise encoded as a JPEG, a stand-in for an uploaded photo """
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+def warmup_model(model, batch_sizes=(1,), rounds: int = 2, regions=()):
+    """ Run predictions on synthetic JPEGs at each batch size, so one-off costs of the first forwards
+    (allocator growth for each activation size, TorchScript profiling and optimization of the traced
+    encoder and of the scripted RFF encoding, first touch of the weights and gallery) are paid before
+    the server reports ready
+
+    Args:
+        batch_sizes (tuple): Batch sizes the server is expected to run, e.g. 1 and the micro-batch size
+        rounds (int): Predictions per batch size, TorchScript optimizes a graph after its first runs
+        regions (tuple): Region galleries searched once each
+    """
+    image = synthetic_jpeg()
+    for batch_size in batch_sizes:
+        for _ in range(rounds):
+            model.predict_batch([image] * batch_size, top_k=5)
+    for region in regions:
+        model.predict_batch([image], top_k=5, region=region)
+
+def share_model_memory(model):
+    """ Move the weights and gallery tensors of a loaded model to shared memory
+
+    Workers forked from the process that loaded the model share its pages copy-on-write, but any write
+    to a page (or a transparent huge page around it) gives the worker a private copy. Tensors in shared
+    memory stay shared whatever happens to their pages.
+
+    The tensors are copied to /dev/shm, which Docker limits to 64 MB unless the container is started with
+    a larger --shm-size (shm_size in compose), so the free space is checked before copying anything.
+    """
+    tensors = [*model.parameters(), *model.buffers(), model.gps_gallery]
+    for gps_gallery, gallery_features in model.region_galleries.values():
+        tensors += [gps_gallery, gallery_features]
+    if model.gallery_index is not None:
+        tensors += [value for value in vars(model.gallery_index).values() if isinstance(value, torch.Tensor)]
+
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors if not t.is_shared()}
+    required = sum(storages.values())
+    if os.path.isdir('/dev/shm'):
+        shm = os.statvfs('/dev/shm')
+        available = shm.f_bavail * shm.f_frsize
+        if required > available:
+            raise RuntimeError(
+                f"SHARE_MODEL_MEMORY needs {required / 2**20:.0f} MB in /dev/shm but only {available / 2**20:.0f} MB "
+                f"are free, start the container with a larger --shm-size (e.g. --shm-size={required // 2**30 + 1}g) "
+                f"or set SHARE_MODEL_MEMORY=0"
+            )
+
+    for tensor in tensors:
+        tensor.share_memory_()
+
+def convert_to_serializable(obj):
+    if isinstance(obj, tuple):
+        return [convert_to_serializable(item) for item in obj]
+    elif isinstance(obj, list):
+        return [convert_to_serializable(item) for item in obj]
+    elif hasattr(obj, 'tolist'):
+        return obj.tolist()
+    elif hasattr(obj, 'numpy'):
+        return obj.numpy().tolist()
+    else:
+        return obj
+
+def predict_batched(model, items):
+    """ Batch function for MicroBatcher, items are (image, k, region) tuples.
+    Returns (top_pred_gps, top_pred_prob, image_features) per item.
+    """
+    BATCH_SIZE.observe(len(items))
+    with STAGE_SECONDS.time('image_encoder'):
+        image_features = model.encode_images([image for image, _, _ in items])
+
+    results = [None] * len(items)
+    for region in {region for _, _, region in items}:
+        rows = [i for i, (_, _, r) in enumerate(items) if r == region]
+        with STAGE_SECONDS.time('gallery_search'):
+            top_pred_gps, top_pred_prob = model.predict_from_features(
+                image_features[rows], max(items[i][1] for i in rows), region=region
+            )
+        for j, i in enumerate(rows):
+            k = items[i][1]
+            results[i] = (top_pred_gps[j, :k], top_pred_prob[j, :k], image_features[i])
+
+    return results
+
+def create_batcher(model, max_batch_size: int, max_wait_ms: float) -> MicroBatcher | None:
+    """ Micro-batching scheduler for single image requests, None when max_batch_size is 1 """
+    if max_batch_size <= 1:
+        return None
+    return MicroBatcher(
+        lambda items: predict_batched(model, items),
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms
+    )
+
+def create_embedding_cache(max_entries: int, max_mb: float = None, persist_path: str = None,
+                           namespace: str = '') -> EmbeddingCache | None:
+    """ Image feature cache of the serving path, None when max_entries is 0 """
+    if max_entries <= 0:
+        return None
+    return EmbeddingCache(
+        max_entries=max_entries,
+        max_bytes=int(max_mb * 2**20) if max_mb else None,
+        persist_path=persist_path,
+        namespace=namespace
+    )
+
+def predict_image(model, file_storage, k=5, batcher=None, region=None, cache=None, ticket=None):
+    """ Top k predictions of one uploaded image
+
+    With a ticket (see admission.AdmissionController) the request is abandoned, raising DeadlineExceeded
+    or ClientDisconnected, when the ticket expires or is cancelled before its image is encoded.
+    """
+    with STAGE_SECONDS.time('read'):
+        data = file_storage.read()
+    predictions = None
+
+    def compute_features():
+        nonlocal predictions
+        if ticket is not None:
+            ticket.check()
+        # decoded and preprocessed on the request thread, the batcher only runs the forward passes
+        with STAGE_SECONDS.time('preprocess'):
+            pixel_values = model.preprocess_images([data])
+        if batcher is not None:
+            future = batcher.submit((pixel_values, k, region), ticket)
+            try:
+                top_pred_gps, top_pred_prob, image_features = future.result(
+                    timeout=ticket.remaining() if ticket is not None else None
+                )
+            except FutureTimeoutError:
+                # still queued or running, the batcher drops it if it has not started yet
+                ticket.cancel('deadline')
+                ticket.check()
         else:
-            return obj
+            if ticket is not None:
+                ticket.check()
+            BATCH_SIZE.observe(1)
+            with STAGE_SECONDS.time('image_encoder'):
+                image_features = model.encode_images(pixel_values)[0]
+            with STAGE_SECONDS.time('gallery_search'):
+                top_pred_gps, top_pred_prob = model.predict_from_features(image_features.unsqueeze(0), k, region=region)
+            top_pred_gps, top_pred_prob = top_pred_gps[0], top_pred_prob[0]
+        predictions = (top_pred_gps, top_pred_prob)
+        return image_features
+
+    if cache is None:
+        compute_features()
+    else:
+        try:
+            # a concurrent request computing the same features is waited for until the deadline of this one,
+            # and if it is abandoned itself this request computes them
+            image_features = cache.get_or_compute(
+                EmbeddingCache.key(data), compute_features,
+                timeout=ticket.remaining() if ticket is not None else None,
+                retry_on=(DeadlineExceeded, ClientDisconnected)
+            )
+        except FutureTimeoutError:
+            ticket.cancel('deadline')
+            ticket.check()
+        if predictions is None:
+            # cache hit, or the features were computed by a concurrent request for the same image
+            with STAGE_SECONDS.time('gallery_search'):
+                top_pred_gps, top_pred_prob = model.predict_from_features(image_features.unsqueeze(0), k, region=region)
+            predictions = (top_pred_gps[0], top_pred_prob[0])
+
+    with STAGE_SECONDS.time('serialize'):
+        return convert_to_serializable(predictions)
+
+def predict_images(model, file_storages, k=5, region=None, cache=None, ticket=None):
+    with STAGE_SECONDS.time('read'):
+        data = [file_storage.read() for file_storage in file_storages]
+    return predict_encoded_images(model, data, k=k, region=region, cache=cache, ticket=ticket)
+
+def predict_stream(model, members, k=5, batch_size=16, region=None, cache=None):
+    """ Predictions of (name, image bytes, error) members read lazily, e.g. from archive.iter_archive,
+    batch_size images at a time. Yields (name, predictions, error) per member in input order,
+    each batch as soon as it is predicted, so at most one batch of images is held at a time.
+    """
+    batch = []
+    for member in members:
+        batch.append(member)
+        if len(batch) == batch_size:
+            yield from _predict_members(model, batch, k, region, cache)
+            batch = []
+    if len(batch) > 0:
+        yield from _predict_members(model, batch, k, region, cache)
+
+def _predict_members(model, members, k, region, cache):
+    readable = [i for i, (_, data, error) in enumerate(members) if error is None]
+    results = [(name, None, error) for name, _, error in members]
+    try:
+        predictions = predict_encoded_images(model, [members[i][1] for i in readable], k=k, region=region, cache=cache)
+    except (OSError, ValueError):
+        # an image of the batch cannot be decoded, predict them one by one to find it
+        predictions = []
+        for i in list(readable):
+            try:
+                predictions.extend(predict_encoded_images(model, [members[i][1]], k=k, region=region, cache=cache))
+            except (OSError, ValueError):
+                readable.remove(i)
+                results[i] = (members[i][0], None, 'Cannot decode the image')
+    for i, prediction in zip(readable, predictions):
+        results[i] = (members[i][0], prediction, None)
+    return results
+
+def predict_encoded_images(model, data, k=5, region=None, cache=None, ticket=None):
+    """ Top k predictions of a batch of encoded images (bytes), encoding only those missing from the cache """
+    if len(data) == 0:
+        return []
+    keys = [EmbeddingCache.key(d) for d in data] if cache is not None else None
+    image_features = [cache.get(key) for key in keys] if cache is not None else [None] * len(data)
+
+    missing = [i for i, features in enumerate(image_features) if features is None]
+    if len(missing) > 0:
+        if ticket is not None:
+            ticket.check()
+        with STAGE_SECONDS.time('preprocess'):
+            pixel_values = model.preprocess_images([data[i] for i in missing])
+        BATCH_SIZE.observe(len(missing))
+        with STAGE_SECONDS.time('image_encoder'):
+            encoded = model.encode_images(pixel_values).cpu()
+        for j, i in enumerate(missing):
+            image_features[i] = encoded[j]
+            if cache is not None:
+                cache.put(keys[i], encoded[j])
+
+    with STAGE_SECONDS.time('gallery_search'):
+        top_pred_gps, top_pred_prob = model.predict_from_features(torch.stack(image_features), top_k=k, region=region)
 
-    return convert_to_serializable(predictions)
\ No newline at end of file
+    with STAGE_SECONDS.time('serialize'):
+        return [convert_to_serializable((gps, prob)) for gps, prob in zip(top_pred_gps, top_pred_prob)]
\ No newline at end of file
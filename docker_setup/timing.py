@@ -0,0 +1,24 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """ Records how long each named phase of the server startup takes """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self) -> str:
+        lines = ["startup timing:"]
+        lines += [f"  {name:<14}{seconds:8.2f} s" for name, seconds in self.phases]
+        lines.append(f"  {'total':<14}{time.perf_counter() - self.start:8.2f} s")
+        return "\n".join(lines)